@@ -1,12 +1,104 @@
-import json
 import csv
 import os
-import requests
+import queue
+import threading
+import time
+import orjson
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime, timedelta
 from dotenv import load_dotenv
+from whoop_common import (
+    create_session, get_retry_delay, MAX_RATE_LIMIT_RETRIES,
+    SLEEP_FIELDNAMES, SAFE_EMAIL_TABLE, flatten_sleep_record
+)
 
 load_dotenv()
 
+# WHOOP app credentials, read once and checked at startup in main()
+WHOOP_CLIENT_ID = os.getenv('WHOOP_CLIENT_ID')
+WHOOP_CLIENT_SECRET = os.getenv('WHOOP_CLIENT_SECRET')
+WHOOP_REDIRECT_URI = os.getenv('WHOOP_REDIRECT_URI')
+
+def respect_rate_limit(response, *args, **kwargs):
+    """Pause only when WHOOP reports the current rate limit window is used up"""
+    remaining = response.headers.get('X-RateLimit-Remaining')
+    reset = response.headers.get('X-RateLimit-Reset')
+    
+    if remaining is None or reset is None:
+        return
+    
+    try:
+        if int(remaining) <= 0:
+            wait_seconds = float(reset)
+            print(f"  ⏳ Rate limit reached - waiting {wait_seconds:.0f} seconds...")
+            time.sleep(wait_seconds)
+    except ValueError:
+        pass
+
+# Every call goes to api.prod.whoop.com, so one session lets all pages and
+# users reuse the same keep-alive connections instead of a new TLS handshake
+SESSION = create_session(hooks=[respect_rate_limit])
+
+# Largest page size the WHOOP v2 collection endpoints accept
+PAGE_LIMIT = 25
+
+# Users fetched at once; each also prefetches one page, so this stays well
+# under the session's connection pool size
+MAX_USER_WORKERS = 8
+
+class SleepFetchError(Exception):
+    """Raised when a page of sleep data cannot be fetched"""
+
+# Finished export files are handed to one writer thread so disk I/O overlaps
+# with the next user's HTTP calls instead of blocking them
+WRITE_QUEUE = queue.Queue()
+_writer_thread = None
+_writer_lock = threading.Lock()
+
+# (owner, path) of every queued file the writer thread failed to write,
+# handed back by flush_writes()
+_failed_writes = []
+
+def _file_writer():
+    """Write queued (path, bytes, owner) items to disk until a None sentinel arrives"""
+    while True:
+        item = WRITE_QUEUE.get()
+        if item is None:
+            break
+        
+        path, data, owner = item
+        try:
+            with open(path, 'wb') as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+        except OSError as e:
+            print(f"  ❌ Error writing {path}: {e}")
+            _failed_writes.append((owner, path))
+
+def queue_file_write(path, data, owner=None):
+    """Hand a finished file to the background writer thread, noting who it belongs to"""
+    global _writer_thread
+    with _writer_lock:
+        if _writer_thread is None:
+            _writer_thread = threading.Thread(target=_file_writer, daemon=True)
+            _writer_thread.start()
+    WRITE_QUEUE.put((path, data, owner))
+
+def flush_writes():
+    """Wait until every queued file is written and synced, returning the (owner, path) of any that failed"""
+    global _writer_thread
+    with _writer_lock:
+        if _writer_thread is not None:
+            WRITE_QUEUE.put(None)
+            _writer_thread.join()
+            _writer_thread = None
+        
+        # The writer thread has finished, so the list is safe to read and reset here
+        failed_writes = _failed_writes[:]
+        _failed_writes.clear()
+    return failed_writes
+
 def ensure_exports_directory():
     """Ensure the exports directory and subdirectories exist"""
     exports_dir = "exports"
@@ -33,8 +125,8 @@ def ensure_exports_directory():
 def load_batch_credentials():
     """Load saved batch credentials"""
     try:
-        with open(".whoop_credentials_batch.json", "r") as f:
-            return json.load(f)
+        with open(".whoop_credentials_batch.json", "rb") as f:
+            return orjson.loads(f.read())
     except FileNotFoundError:
         print("❌ No batch credentials file found. Please run batch authentication first:")
         print("   python src/batch_whoopy_auth.py")
@@ -46,8 +138,8 @@ def load_batch_credentials():
 def save_batch_credentials(credentials_dict):
     """Save updated batch credentials"""
     try:
-        with open(".whoop_credentials_batch.json", "w") as f:
-            json.dump(credentials_dict, f, indent=2)
+        with open(".whoop_credentials_batch.json", "wb") as f:
+            f.write(orjson.dumps(credentials_dict, option=orjson.OPT_INDENT_2))
         print("✅ Batch credentials updated")
     except Exception as e:
         print(f"❌ Error saving batch credentials: {e}")
@@ -73,36 +165,28 @@ def refresh_user_token_batch(credentials):
         print("  ❌ No refresh token available")
         return False
     
-    # Get environment variables
-    client_id = os.getenv('WHOOP_CLIENT_ID')
-    client_secret = os.getenv('WHOOP_CLIENT_SECRET')
-    redirect_uri = os.getenv('WHOOP_REDIRECT_URI')
-    
-    if not all([client_id, client_secret, redirect_uri]):
-        print("  ❌ Missing environment variables for token refresh")
-        return False
-    
     # WHOOP token refresh endpoint
     token_url = "https://api.prod.whoop.com/oauth/oauth2/token"
     
     # Prepare refresh request (following WHOOP API documentation)
     refresh_data = {
         "grant_type": "refresh_token",
-        "client_id": client_id,
-        "client_secret": client_secret,
+        "client_id": WHOOP_CLIENT_ID,
+        "client_secret": WHOOP_CLIENT_SECRET,
         "scope": "offline",  # Required for refresh token flow
         "refresh_token": credentials['refresh_token']
     }
     
     try:
-        response = requests.post(token_url, data=refresh_data)
+        response = SESSION.post(token_url, data=refresh_data)
         
         if response.status_code == 200:
             token_response = response.json()
             
             # Calculate new expiration time
             expires_in = token_response.get('expires_in', 3600)
-            expires_at = datetime.now() + timedelta(seconds=expires_in)
+            refreshed_at = datetime.now()
+            expires_at = refreshed_at + timedelta(seconds=expires_in)
             
             # Update credentials
             credentials.update({
@@ -110,8 +194,9 @@ def refresh_user_token_batch(credentials):
                 "refresh_token": token_response.get('refresh_token', credentials.get('refresh_token')),
                 "expires_in": expires_in,
                 "expires_at": expires_at.isoformat(),
+                "expires_at_ts": expires_at.timestamp(),
                 "token_type": token_response.get('token_type', 'bearer'),
-                "last_refreshed": datetime.now().isoformat()
+                "last_refreshed": refreshed_at.isoformat()
             })
             
             print("  ✅ Token refreshed successfully!")
@@ -124,105 +209,51 @@ def refresh_user_token_batch(credentials):
                 error_data = response.json()
                 print(f"  Error details: {error_data}")
             except:
-                print(f"  Raw response: {response.text[:200]}")
+                print(f"  Raw response: {response.content[:200].decode('utf-8', errors='replace')}")
             return False
             
     except Exception as e:
         print(f"  ❌ Exception during token refresh: {e}")
         return False
 
-def test_user_token(credentials):
-    """Test if user token is valid"""
-    headers = {
-        "Authorization": f"Bearer {credentials['access_token']}",
-        "Content-Type": "application/json"
-    }
-    
-    profile_url = "https://api.prod.whoop.com/developer/v2/user/profile/basic"
-    
-    try:
-        response = requests.get(profile_url, headers=headers)
-        return response.status_code == 200
-    except:
-        return False
+def get_export_basename(user_email, start_date, end_date, timestamp):
+    """Build the filename stem shared by a user's CSV and JSON exports"""
+    safe_user_id = user_email.translate(SAFE_EMAIL_TABLE)
+    if start_date and end_date:
+        date_range = f"{start_date.strftime('%Y%m%d')}_{end_date.strftime('%Y%m%d')}"
+        return f"sleep_data_batch_{safe_user_id}_{date_range}_{timestamp}"
+    return f"sleep_data_batch_{safe_user_id}_{timestamp}"
 
-def check_token_validity(credentials):
-    """Check if token is still valid without refreshing"""
-    if not credentials.get('access_token'):
-        return False
-    
-    headers = {
-        "Authorization": f"Bearer {credentials['access_token']}",
-        "Content-Type": "application/json"
-    }
-    
-    profile_url = "https://api.prod.whoop.com/developer/v2/user/profile/basic"
+def export_sleep_data_to_csv(sleep_pages, user_filename, user_email="user"):
+    """Stream pages of sleep records to a CSV file as they are fetched"""
+    csvfile = None
+    writer = None
+    record_count = 0
+    completed = False
     
     try:
-        response = requests.get(profile_url, headers=headers)
-        return response.status_code == 200
-    except:
-        return False
-
-def flatten_sleep_record(record):
-    """Flatten a sleep record for CSV export with expanded nested fields"""
-    flat_record = {}
-    
-    for key, value in record.items():
-        if isinstance(value, dict):
-            # Special handling for score_sleep_needed and score_stage_summary
-            if key in ['score_sleep_needed', 'score_stage_summary']:
-                # Expand these nested dictionaries into individual columns
-                for nested_key, nested_value in value.items():
-                    flat_record[f"{key}.{nested_key}"] = nested_value
-            else:
-                # For other nested dictionaries, use the original flattening
-                for nested_key, nested_value in value.items():
-                    flat_record[f"{key}_{nested_key}"] = nested_value
-        elif isinstance(value, list):
-            # Convert lists to JSON strings
-            flat_record[key] = json.dumps(value)
-        else:
-            flat_record[key] = value
-    
-    return flat_record
-
-def export_sleep_data_to_csv(sleep_records, exports_dir, user_email="user", start_date=None, end_date=None):
-    """Export sleep data to CSV files"""
-    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-    
-    if not sleep_records:
+        for records in sleep_pages:
+            if writer is None:
+                csvfile = open(user_filename, 'w', newline='', encoding='utf-8')
+                writer = csv.writer(csvfile)
+                writer.writerow(SLEEP_FIELDNAMES)
+            
+            # Positional rows go straight to the C writer without a dict per record
+            writer.writerows(flatten_sleep_record(record, user_email) for record in records)
+            record_count += len(records)
+        completed = True
+    finally:
+        if csvfile:
+            csvfile.close()
+            # Don't leave a partial export behind, whatever interrupted it
+            if not completed:
+                os.remove(user_filename)
+    
+    if not record_count:
         print("  ⚠️  No sleep records to export")
         return None
     
-    # Flatten all records
-    flattened_records = []
-    for record in sleep_records:
-        flat_record = flatten_sleep_record(record)
-        flat_record['user_email'] = user_email
-        flattened_records.append(flat_record)
-    
-    # Create user-specific filename with date range
-    safe_user_id = user_email.replace('@', '_at_').replace('.', '_')
-    if start_date and end_date:
-        date_range = f"{start_date.strftime('%Y%m%d')}_{end_date.strftime('%Y%m%d')}"
-        user_filename = os.path.join(exports_dir, f"sleep_data_batch_{safe_user_id}_{date_range}_{timestamp}.csv")
-    else:
-        user_filename = os.path.join(exports_dir, f"sleep_data_batch_{safe_user_id}_{timestamp}.csv")
-    
-    # Get all field names
-    fieldnames = set()
-    for record in flattened_records:
-        fieldnames.update(record.keys())
-    fieldnames = sorted(list(fieldnames))
-    
-    # Write CSV
-    with open(user_filename, 'w', newline='', encoding='utf-8') as csvfile:
-        writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-        writer.writeheader()
-        writer.writerows(flattened_records)
-    
-    print(f"  ✅ User CSV exported: {user_filename} ({len(flattened_records)} records)")
+    print(f"  ✅ User CSV exported: {user_filename} ({record_count} records)")
     return user_filename
 
 def get_date_range_from_user():
@@ -258,8 +289,53 @@ def get_date_range_from_user():
         except Exception as e:
             print(f"❌ Error: {e}")
 
+def fetch_sleep_page(headers, params):
+    """Fetch a single page of sleep data, raising SleepFetchError on failure"""
+    # WHOOP v2 sleep endpoint
+    sleep_url = "https://api.prod.whoop.com/developer/v2/activity/sleep"
+    rate_limited_attempts = 0
+    
+    while True:
+        try:
+            response = SESSION.get(sleep_url, headers=headers, params=params)
+            
+            if response.status_code == 200:
+                return orjson.loads(response.content)
+                
+        except Exception as e:
+            print(f"      ❌ Exception: {e}")
+            raise SleepFetchError(str(e))
+        
+        if response.status_code == 401:
+            print(f"      ❌ 401: Unauthorized - Token may be expired")
+            raise SleepFetchError("Unauthorized")
+            
+        elif response.status_code == 403:
+            print(f"      ❌ 403: Forbidden - Check app permissions")
+            raise SleepFetchError("Forbidden")
+            
+        elif response.status_code == 429:
+            # Give up on the page rather than block this worker indefinitely
+            if rate_limited_attempts >= MAX_RATE_LIMIT_RETRIES:
+                print(f"      ❌ 429: Rate Limited - Giving up after {rate_limited_attempts} retries")
+                raise SleepFetchError("Rate limited")
+            wait_seconds = get_retry_delay(response, rate_limited_attempts)
+            rate_limited_attempts += 1
+            print(f"      ❌ 429: Rate Limited - Waiting {wait_seconds:.0f} seconds...")
+            time.sleep(wait_seconds)
+            continue
+            
+        else:
+            print(f"      ❌ {response.status_code}: Unexpected status")
+            try:
+                error_data = response.json()
+                print(f"      Error details: {error_data}")
+            except:
+                print(f"      Raw response: {response.content[:200].decode('utf-8', errors='replace')}")
+            raise SleepFetchError(f"Unexpected status {response.status_code}")
+
 def fetch_user_sleep_data(credentials, start_date=None, end_date=None, days_back=30):
-    """Fetch sleep data for a specific user"""
+    """Fetch sleep data for a specific user, yielding one page of records at a time"""
     if start_date and end_date:
         print(f"  😴 Fetching sleep data from {start_date.strftime('%Y-%m-%d')} to {end_date.strftime('%Y-%m-%d')}...")
     else:
@@ -276,77 +352,48 @@ def fetch_user_sleep_data(credentials, start_date=None, end_date=None, days_back
         "Content-Type": "application/json"
     }
     
-    # WHOOP v2 sleep endpoint
-    sleep_url = "https://api.prod.whoop.com/developer/v2/activity/sleep"
+    # The date range is the same for every page, so format it once
+    params = {
+        'start': start_date.strftime('%Y-%m-%dT%H:%M:%S.%fZ'),
+        'end': end_date.strftime('%Y-%m-%dT%H:%M:%S.%fZ'),
+        'limit': PAGE_LIMIT
+    }
     
-    all_sleep_records = []
-    next_token = None
-    page_count = 0
+    total_records = 0
+    page_count = 1
     
-    while True:
-        page_count += 1
+    # One background worker keeps the next page in flight while the caller
+    # flattens and writes the current one
+    with ThreadPoolExecutor(max_workers=1) as prefetcher:
         print(f"    📄 Fetching page {page_count}...")
+        pending_page = prefetcher.submit(fetch_sleep_page, headers, params)
         
-        # Prepare parameters
-        params = {
-            'start': start_date.strftime('%Y-%m-%dT%H:%M:%S.%fZ'),
-            'end': end_date.strftime('%Y-%m-%dT%H:%M:%S.%fZ'),
-            'limit': 25  # WHOOP API limit
-        }
-        
-        if next_token:
-            params['nextToken'] = next_token
-        
-        try:
-            response = requests.get(sleep_url, headers=headers, params=params)
+        while True:
+            data = pending_page.result()
             
-            if response.status_code == 200:
-                data = response.json()
-                
-                # Extract records
-                records = data.get('records', [])
-                if records:
-                    all_sleep_records.extend(records)
-                    print(f"      ✅ Retrieved {len(records)} sleep records")
-                    
-                    # Check for next page
-                    next_token = data.get('next_token')
-                    if not next_token:
-                        print(f"      📄 No more pages available")
-                        break
-                else:
-                    print(f"      📄 No records found in response")
-                    break
-                    
-            elif response.status_code == 401:
-                print(f"      ❌ 401: Unauthorized - Token may be expired")
-                return None
-                
-            elif response.status_code == 403:
-                print(f"      ❌ 403: Forbidden - Check app permissions")
-                return None
-                
-            elif response.status_code == 429:
-                print(f"      ❌ 429: Rate Limited - Waiting 60 seconds...")
-                import time
-                time.sleep(60)
-                continue
-                
-            else:
-                print(f"      ❌ {response.status_code}: Unexpected status")
-                try:
-                    error_data = response.json()
-                    print(f"      Error details: {error_data}")
-                except:
-                    print(f"      Raw response: {response.text[:200]}")
-                return None
-                
-        except Exception as e:
-            print(f"      ❌ Exception: {e}")
-            return None
+            # Extract records
+            records = data.get('records', [])
+            if not records:
+                print(f"      📄 No records found in response")
+                break
+            
+            total_records += len(records)
+            print(f"      ✅ Retrieved {len(records)} sleep records")
+            
+            # Request the next page before handing this one to the caller
+            next_token = data.get('next_token')
+            if next_token:
+                page_count += 1
+                print(f"    📄 Fetching page {page_count}...")
+                pending_page = prefetcher.submit(fetch_sleep_page, headers, {**params, 'nextToken': next_token})
+            
+            yield records
+            
+            if not next_token:
+                print(f"      📄 No more pages available")
+                break
     
-    print(f"    ✅ Total sleep records: {len(all_sleep_records)}")
-    return all_sleep_records
+    print(f"    ✅ Total sleep records: {total_records}")
 
 def get_user_profile(credentials):
     """Get user profile information"""
@@ -360,7 +407,7 @@ def get_user_profile(credentials):
     profile_url = "https://api.prod.whoop.com/developer/v2/user/profile/basic"
     
     try:
-        response = requests.get(profile_url, headers=headers)
+        response = SESSION.get(profile_url, headers=headers)
         
         if response.status_code == 200:
             profile_data = response.json()
@@ -374,42 +421,78 @@ def get_user_profile(credentials):
         print(f"  ❌ Error fetching profile: {e}")
         return None
 
+def update_sleep_analysis(analysis, records):
+    """Add a page of sleep records to the running analysis totals"""
+    analysis['record_count'] += len(records)
+    
+    # Sum the page's sleep scores with one reduction instead of per-record bookkeeping
+    scores = [
+        record['score'].get('sleep_performance_percentage')
+        for record in records
+        if record.get('score')
+    ]
+    scores = [score for score in scores if score is not None]
+    analysis['total_score'] += sum(scores)
+    analysis['valid_scores'] += len(scores)
+    
+    # Calculate duration from start/end times (fromisoformat reads the
+    # trailing 'Z' natively on Python 3.11+, so no string rewriting is needed)
+    for record in records:
+        if 'start' in record and 'end' in record:
+            try:
+                duration = datetime.fromisoformat(record['end']) - datetime.fromisoformat(record['start'])
+                analysis['total_duration'] += duration.total_seconds() / 3600
+            except:
+                pass
+
+def print_sleep_analysis(analysis):
+    """Print average sleep duration and score from the running totals"""
+    print(f"  📈 Basic Analysis:")
+    
+    if analysis['record_count'] > 0:
+        avg_duration = analysis['total_duration'] / analysis['record_count']
+        print(f"    Average sleep duration: {avg_duration:.2f} hours")
+    
+    if analysis['valid_scores'] > 0:
+        avg_score = analysis['total_score'] / analysis['valid_scores']
+        print(f"    Average sleep score: {avg_score:.1f}%")
+
+def build_sleep_json(json_info, record_chunks):
+    """Build the JSON export around pages of already serialized sleep records"""
+    # Drop the closing brace so sleep_records can be spliced in as the last key
+    header = orjson.dumps(json_info, option=orjson.OPT_INDENT_2)[:-2]
+    return header + b',\n  "sleep_records": [' + b','.join(record_chunks) + b']\n}'
+
 def process_user(user_email, user_credentials, exports_dir, start_date=None, end_date=None, days_back=30):
     """Process a single user's sleep data"""
     print(f"\n👤 Processing user: {user_email}")
     print("-" * 50)
     
-    # First check if current token is still valid
-    if check_token_validity(user_credentials):
-        print("  ✅ Current token is still valid!")
-    elif is_token_expired(user_credentials):
+    # One clock read per user keeps the CSV, JSON and fetch_info timestamps in step
+    run_time = datetime.now()
+    export_basename = get_export_basename(user_email, start_date, end_date, run_time.strftime('%Y%m%d_%H%M%S'))
+    
+    # Trust the stored expiry instead of probing the API before every user
+    if is_token_expired(user_credentials):
         print("  ❌ Token has expired. Attempting automatic refresh...")
         
         # Use our batch-compatible token refresh function
-        if refresh_user_token_batch(user_credentials):
-            # Test the refreshed token
-            if test_user_token(user_credentials):
-                print("  ✅ Token refreshed successfully!")
-            else:
-                print("  ❌ Refreshed token failed test.")
-                print("  💡 You may need to re-authenticate this user manually:")
-                print(f"     python src/reauthenticate_user.py")
-                print("  ⏭️  Skipping user for now.")
-                return False
-        else:
+        if not refresh_user_token_batch(user_credentials):
             print("  ❌ Token refresh failed.")
             print("  💡 You may need to re-authenticate this user manually:")
             print(f"     python src/reauthenticate_user.py")
             print("  ⏭️  Skipping user for now.")
             return False
     else:
-        time_left = datetime.fromisoformat(user_credentials['expires_at']) - datetime.now()
+        time_left = datetime.fromisoformat(user_credentials['expires_at']) - run_time
         print(f"  ✅ Token valid for: {time_left}")
     
-    # Get user profile
+    # Get user profile (this is also the only request that checks the token)
     profile = get_user_profile(user_credentials)
     if not profile:
         print("  ❌ Could not fetch user profile. Skipping user.")
+        print("  💡 If the token was rejected, re-authenticate this user manually:")
+        print(f"     python src/reauthenticate_user.py")
         return False
     
     # Update user info in credentials
@@ -424,76 +507,46 @@ def process_user(user_email, user_credentials, exports_dir, start_date=None, end
     user_name = f"{profile.get('first_name', 'Unknown')} {profile.get('last_name', 'Unknown')}"
     whoop_user_id = profile.get('user_id', 'Unknown')
     
-    # Fetch sleep data
-    sleep_records = fetch_user_sleep_data(user_credentials, start_date, end_date, days_back)
+    # Fetch and export sleep data page by page, keeping running analysis totals
+    record_chunks = []
+    analysis = {'record_count': 0, 'total_duration': 0, 'total_score': 0, 'valid_scores': 0}
     
-    if sleep_records:
-        # Export to CSV
-        csv_filename = export_sleep_data_to_csv(sleep_records, exports_dir, user_email, start_date, end_date)
-        
+    def tracked_pages():
+        for records in fetch_user_sleep_data(user_credentials, start_date, end_date, days_back):
+            update_sleep_analysis(analysis, records)
+            # Serialize each page once as it arrives; the JSON export only joins them
+            record_chunks.append(orjson.dumps(records)[1:-1])
+            yield records
+    
+    try:
+        csv_path = os.path.join(exports_dir, f"{export_basename}.csv")
+        csv_filename = export_sleep_data_to_csv(tracked_pages(), csv_path, user_email)
+    except SleepFetchError:
+        csv_filename = None
+    
+    if csv_filename:
         # Save to JSON as well
-        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-        safe_user_id = user_email.replace('@', '_at_').replace('.', '_')
-        if start_date and end_date:
-            date_range = f"{start_date.strftime('%Y%m%d')}_{end_date.strftime('%Y%m%d')}"
-            json_filename = os.path.join(exports_dir, "json", f"sleep_data_batch_{safe_user_id}_{date_range}_{timestamp}.json")
-        else:
-            json_filename = os.path.join(exports_dir, "json", f"sleep_data_batch_{safe_user_id}_{timestamp}.json")
+        json_filename = os.path.join(exports_dir, "json", f"{export_basename}.json")
         
-        json_data = {
+        json_info = {
             'user_info': {
                 'email': user_email,
                 'whoop_user_id': whoop_user_id,
                 'name': user_name
             },
             'fetch_info': {
-                'timestamp': datetime.now().isoformat(),
+                'timestamp': run_time.isoformat(),
                 'start_date': start_date.strftime('%Y-%m-%d'),
                 'end_date': end_date.strftime('%Y-%m-%d'),
-                'total_records': len(sleep_records)
-            },
-            'sleep_records': sleep_records
+                'total_records': analysis['record_count']
+            }
         }
         
-        with open(json_filename, 'w') as f:
-            json.dump(json_data, f, indent=2)
-        
-        print(f"  ✅ JSON data saved: {json_filename}")
+        queue_file_write(json_filename, build_sleep_json(json_info, record_chunks), owner=user_email)
         
-        # Basic analysis
-        print(f"  📈 Basic Analysis:")
-        
-        # Calculate average sleep duration
-        total_duration = 0
-        total_score = 0
-        valid_scores = 0
-        
-        for record in sleep_records:
-            # Calculate sleep score
-            if 'score' in record and record['score']:
-                score = record['score'].get('sleep_performance_percentage')
-                if score is not None:
-                    total_score += score
-                    valid_scores += 1
-            
-            # Calculate duration from start/end times
-            if 'start' in record and 'end' in record:
-                try:
-                    start_time = datetime.fromisoformat(record['start'].replace('Z', '+00:00'))
-                    end_time = datetime.fromisoformat(record['end'].replace('Z', '+00:00'))
-                    duration = (end_time - start_time).total_seconds() / 3600
-                    total_duration += duration
-                except:
-                    pass
-        
-        if len(sleep_records) > 0:
-            avg_duration = total_duration / len(sleep_records)
-            print(f"    Average sleep duration: {avg_duration:.2f} hours")
-        
-        if valid_scores > 0:
-            avg_score = total_score / valid_scores
-            print(f"    Average sleep score: {avg_score:.1f}%")
+        print(f"  ✅ JSON data queued: {json_filename}")
         
+        print_sleep_analysis(analysis)
         return True
     else:
         print("  ❌ No sleep data retrieved")
@@ -504,6 +557,11 @@ def main():
     print("🔄 Batch WHOOP Sleep Data Fetcher")
     print("="*60)
     
+    # Fail fast on a misconfigured .env instead of at the first token refresh
+    if not all([WHOOP_CLIENT_ID, WHOOP_CLIENT_SECRET, WHOOP_REDIRECT_URI]):
+        print("❌ Missing environment variables. Please set WHOOP_CLIENT_ID, WHOOP_CLIENT_SECRET, and WHOOP_REDIRECT_URI in .env")
+        return
+    
     # Create exports directory
     exports_dir = ensure_exports_directory()
     
@@ -520,36 +578,37 @@ def main():
     # Track results
     successful_users = []
     failed_users = []
-    updated_credentials = {}
     
-    # Process each user
-    for user_email, user_credentials in batch_credentials.items():
-        try:
-            # Process the user
-            success = process_user(user_email, user_credentials, exports_dir, start_date, end_date)
+    # Users are independent, so process them in parallel to overlap network waits
+    with ThreadPoolExecutor(max_workers=MAX_USER_WORKERS) as executor:
+        futures = {
+            executor.submit(process_user, user_email, user_credentials, exports_dir, start_date, end_date): user_email
+            for user_email, user_credentials in batch_credentials.items()
+        }
+        
+        for future in as_completed(futures):
+            user_email = futures[future]
+            try:
+                success = future.result()
+            except Exception as e:
+                print(f"  ❌ Unexpected error processing {user_email}: {e}")
+                success = False
             
             if success:
                 successful_users.append(user_email)
-                # Store updated credentials
-                updated_credentials[user_email] = user_credentials
             else:
                 failed_users.append(user_email)
-                # Keep original credentials for failed users
-                updated_credentials[user_email] = user_credentials
-                
-        except Exception as e:
-            print(f"  ❌ Unexpected error processing {user_email}: {e}")
+    
+    # Make sure every JSON export is on disk before reporting; a user whose
+    # export could not be written has not been processed successfully after all
+    for user_email, path in flush_writes():
+        if user_email in successful_users:
+            print(f"❌ JSON export for {user_email} was not saved: {path}")
+            successful_users.remove(user_email)
             failed_users.append(user_email)
-            updated_credentials[user_email] = user_credentials
-        
-        # Add delay between users to avoid rate limiting
-        if len(batch_credentials) > 1:
-            print("  ⏳ Waiting 5 seconds before next user...")
-            import time
-            time.sleep(5)
-    
-    # Save updated credentials
-    save_batch_credentials(updated_credentials)
+    
+    # Save updated credentials (refreshed tokens were updated in place)
+    save_batch_credentials(batch_credentials)
     
     # Final summary
     print("\n" + "="*60)
@@ -1,12 +1,23 @@
-import json
 import csv
 import os
-import requests
+import time
+import orjson
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from dotenv import load_dotenv
+from whoop_common import (
+    create_session, get_retry_delay, MAX_RATE_LIMIT_RETRIES,
+    SLEEP_FIELDNAMES, SAFE_EMAIL_TABLE, flatten_sleep_record
+)
 
 load_dotenv()
 
+# Largest page size the WHOOP v2 collection endpoints accept
+PAGE_LIMIT = 25
+
+# The profile call and every sleep page reuse the same keep-alive connection
+SESSION = create_session()
+
 def ensure_exports_directory():
     """Ensure the exports directory exists"""
     exports_dir = "exports"
@@ -18,8 +29,8 @@ def ensure_exports_directory():
 def load_credentials():
     """Load saved credentials"""
     try:
-        with open(".whoop_credentials.json", "r") as f:
-            return json.load(f)
+        with open(".whoop_credentials.json", "rb") as f:
+            return orjson.loads(f.read())
     except FileNotFoundError:
         print("❌ No credentials file found. Please run authentication first:")
         print("   python src/whoopy_auth_custom.py")
@@ -28,128 +39,58 @@ def load_credentials():
         print(f"❌ Error loading credentials: {e}")
         return None
 
-def flatten_sleep_record(record):
-    """Flatten a sleep record for CSV export"""
-    flat_record = {}
-    
-    for key, value in record.items():
-        if isinstance(value, dict):
-            # Flatten nested dictionaries
-            for nested_key, nested_value in value.items():
-                flat_record[f"{key}_{nested_key}"] = nested_value
-        elif isinstance(value, list):
-            # Convert lists to JSON strings
-            flat_record[key] = json.dumps(value)
-        else:
-            flat_record[key] = value
-    
-    return flat_record
-
-def export_sleep_data_to_csv(sleep_records, exports_dir, user_email="user"):
+def export_sleep_data_to_csv(sleep_records, exports_dir, user_email="user", timestamp=None):
     """Export sleep data to CSV files"""
-    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+    if timestamp is None:
+        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
     
     if not sleep_records:
         print("⚠️  No sleep records to export")
         return None
     
-    # Flatten all records
-    flattened_records = []
-    for record in sleep_records:
-        flat_record = flatten_sleep_record(record)
-        flat_record['user_email'] = user_email
-        flattened_records.append(flat_record)
-    
     # Create user-specific filename
-    safe_user_id = user_email.replace('@', '_at_').replace('.', '_')
+    safe_user_id = user_email.translate(SAFE_EMAIL_TABLE)
     user_filename = os.path.join(exports_dir, f"sleep_data_custom_{safe_user_id}_{timestamp}.csv")
     
-    # Get all field names
-    fieldnames = set()
-    for record in flattened_records:
-        fieldnames.update(record.keys())
-    fieldnames = sorted(list(fieldnames))
-    
-    # Write CSV
+    # Write CSV from the fixed column schema, one positional row per record
     with open(user_filename, 'w', newline='', encoding='utf-8') as csvfile:
-        writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-        writer.writeheader()
-        writer.writerows(flattened_records)
+        writer = csv.writer(csvfile)
+        writer.writerow(SLEEP_FIELDNAMES)
+        writer.writerows(flatten_sleep_record(record, user_email) for record in sleep_records)
     
-    print(f"✅ User CSV exported: {user_filename} ({len(flattened_records)} records)")
+    print(f"✅ User CSV exported: {user_filename} ({len(sleep_records)} records)")
     return user_filename
 
-def fetch_sleep_data(credentials, days_back=30):
-    """Fetch sleep data using custom authentication"""
-    print(f"😴 Fetching sleep data for last {days_back} days...")
-    
-    # Calculate date range
-    end_date = datetime.now()
-    start_date = end_date - timedelta(days=days_back)
-    
-    print(f"📅 Date range: {start_date.strftime('%Y-%m-%d')} to {end_date.strftime('%Y-%m-%d')}")
-    
-    # Prepare headers
-    headers = {
-        "Authorization": f"Bearer {credentials['access_token']}",
-        "Content-Type": "application/json"
-    }
-    
+def fetch_sleep_page(headers, params):
+    """Fetch a single page of sleep data, returning None on failure"""
     # WHOOP v2 sleep endpoint
     sleep_url = "https://api.prod.whoop.com/developer/v2/activity/sleep"
-    
-    all_sleep_records = []
-    next_token = None
-    page_count = 0
+    rate_limited_attempts = 0
     
     while True:
-        page_count += 1
-        print(f"  📄 Fetching page {page_count}...")
-        
-        # Prepare parameters
-        params = {
-            'start': start_date.strftime('%Y-%m-%dT%H:%M:%S.%fZ'),
-            'end': end_date.strftime('%Y-%m-%dT%H:%M:%S.%fZ'),
-            'limit': 25  # WHOOP API limit
-        }
-        
-        if next_token:
-            params['nextToken'] = next_token
-        
         try:
-            response = requests.get(sleep_url, headers=headers, params=params)
+            response = SESSION.get(sleep_url, headers=headers, params=params)
             
             if response.status_code == 200:
-                data = response.json()
+                return orjson.loads(response.content)
                 
-                # Extract records
-                records = data.get('records', [])
-                if records:
-                    all_sleep_records.extend(records)
-                    print(f"    ✅ Retrieved {len(records)} sleep records")
-                    
-                    # Check for next page
-                    next_token = data.get('next_token')
-                    if not next_token:
-                        print(f"    📄 No more pages available")
-                        break
-                else:
-                    print(f"    📄 No records found in response")
-                    break
-                    
             elif response.status_code == 401:
                 print(f"    ❌ 401: Unauthorized - Token may be expired")
                 print(f"    💡 Run: python src/whoopy_auth_custom.py")
-                break
+                return None
                 
             elif response.status_code == 403:
                 print(f"    ❌ 403: Forbidden - Check app permissions")
-                break
+                return None
                 
             elif response.status_code == 429:
-                print(f"    ❌ 429: Rate Limited - Waiting 60 seconds...")
-                import time
-                time.sleep(60)
+                if rate_limited_attempts >= MAX_RATE_LIMIT_RETRIES:
+                    print(f"    ❌ 429: Rate Limited - Giving up after {rate_limited_attempts} retries")
+                    return None
+                wait_seconds = get_retry_delay(response, rate_limited_attempts)
+                rate_limited_attempts += 1
+                print(f"    ❌ 429: Rate Limited - Waiting {wait_seconds:.0f} seconds...")
+                time.sleep(wait_seconds)
                 continue
                 
             else:
@@ -158,16 +99,104 @@ def fetch_sleep_data(credentials, days_back=30):
                     error_data = response.json()
                     print(f"    Error details: {error_data}")
                 except:
-                    print(f"    Raw response: {response.text[:200]}")
-                break
+                    print(f"    Raw response: {response.content[:200].decode('utf-8', errors='replace')}")
+                return None
                 
         except Exception as e:
             print(f"    ❌ Exception: {e}")
-            break
+            return None
+
+def fetch_sleep_data(credentials, days_back=30):
+    """Fetch sleep data using custom authentication"""
+    print(f"😴 Fetching sleep data for last {days_back} days...")
+    
+    # Calculate date range
+    end_date = datetime.now()
+    start_date = end_date - timedelta(days=days_back)
+    
+    print(f"📅 Date range: {start_date.strftime('%Y-%m-%d')} to {end_date.strftime('%Y-%m-%d')}")
+    
+    # Prepare headers
+    headers = {
+        "Authorization": f"Bearer {credentials['access_token']}",
+        "Content-Type": "application/json"
+    }
+    
+    # Prepare parameters
+    params = {
+        'start': start_date.strftime('%Y-%m-%dT%H:%M:%S.%fZ'),
+        'end': end_date.strftime('%Y-%m-%dT%H:%M:%S.%fZ'),
+        'limit': PAGE_LIMIT
+    }
+    
+    all_sleep_records = []
+    page_count = 1
+    
+    # One background worker keeps the next page in flight while the
+    # current one is added to the results
+    with ThreadPoolExecutor(max_workers=1) as prefetcher:
+        print(f"  📄 Fetching page {page_count}...")
+        pending_page = prefetcher.submit(fetch_sleep_page, headers, params)
+        
+        while True:
+            data = pending_page.result()
+            if data is None:
+                break
+            
+            # Extract records
+            records = data.get('records', [])
+            if not records:
+                print(f"    📄 No records found in response")
+                break
+            
+            # Request the next page before handling this one; a short page
+            # is the last one, so don't spend a round trip confirming it
+            next_token = data.get('next_token') if len(records) >= PAGE_LIMIT else None
+            if next_token:
+                page_count += 1
+                print(f"  📄 Fetching page {page_count}...")
+                pending_page = prefetcher.submit(fetch_sleep_page, headers, {**params, 'nextToken': next_token})
+            
+            all_sleep_records.extend(records)
+            print(f"    ✅ Retrieved {len(records)} sleep records")
+            
+            if not next_token:
+                print(f"    📄 No more pages available")
+                break
     
     print(f"  ✅ Total sleep records: {len(all_sleep_records)}")
     return all_sleep_records
 
+def get_sleep_hours(record):
+    """Return a record's sleep duration in hours, or None if it can't be parsed"""
+    # fromisoformat reads the trailing 'Z' natively on Python 3.11+
+    try:
+        duration = datetime.fromisoformat(record['end']) - datetime.fromisoformat(record['start'])
+        return duration.total_seconds() / 3600
+    except (KeyError, TypeError, ValueError):
+        return None
+
+def print_sleep_analysis(sleep_records):
+    """Print average sleep duration and score for the fetched records"""
+    print(f"\n📈 Basic Analysis:")
+    
+    # Each statistic is a single reduction over the records
+    durations = [hours for hours in map(get_sleep_hours, sleep_records) if hours is not None]
+    scores = [
+        record['score'].get('sleep_performance_percentage')
+        for record in sleep_records
+        if record.get('score')
+    ]
+    scores = [score for score in scores if score is not None]
+    
+    if sleep_records:
+        avg_duration = sum(durations) / len(sleep_records)
+        print(f"   Average sleep duration: {avg_duration:.2f} hours")
+    
+    if scores:
+        avg_score = sum(scores) / len(scores)
+        print(f"   Average sleep score: {avg_score:.1f}%")
+
 def get_user_profile(credentials):
     """Get user profile information"""
     print("👤 Fetching user profile...")
@@ -180,10 +209,10 @@ def get_user_profile(credentials):
     profile_url = "https://api.prod.whoop.com/developer/v2/user/profile/basic"
     
     try:
-        response = requests.get(profile_url, headers=headers)
+        response = SESSION.get(profile_url, headers=headers)
         
         if response.status_code == 200:
-            profile_data = response.json()
+            profile_data = orjson.loads(response.content)
             print(f"✅ Profile retrieved: {profile_data.get('first_name', 'Unknown')} {profile_data.get('last_name', 'Unknown')}")
             return profile_data
         else:
@@ -199,6 +228,10 @@ def main():
     print("🔄 Custom WHOOP Sleep Data Fetcher")
     print("="*60)
     
+    # One clock read for the token check and both export filenames
+    run_time = datetime.now()
+    timestamp = run_time.strftime('%Y%m%d_%H%M%S')
+    
     # Create exports directory
     exports_dir = ensure_exports_directory()
     
@@ -211,7 +244,7 @@ def main():
     if 'expires_at' in credentials:
         try:
             expires_at = datetime.fromisoformat(credentials['expires_at'])
-            if datetime.now() > expires_at:
+            if run_time > expires_at:
                 print("❌ Token has expired. Attempting automatic refresh...")
                 
                 # Import and use token refresh handler
@@ -238,7 +271,7 @@ def main():
                     return
                     
             else:
-                time_left = expires_at - datetime.now()
+                time_left = expires_at - run_time
                 print(f"✅ Token valid for: {time_left}")
         except:
             print("⚠️  Could not check token expiration")
@@ -257,10 +290,9 @@ def main():
     
     if sleep_records:
         # Export to CSV
-        csv_filename = export_sleep_data_to_csv(sleep_records, exports_dir, user_email)
+        csv_filename = export_sleep_data_to_csv(sleep_records, exports_dir, user_email, timestamp)
         
         # Save to JSON as well
-        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
         json_filename = f"sleep_data_custom_{timestamp}.json"
         
         json_data = {
@@ -270,14 +302,14 @@ def main():
                 'name': user_name
             },
             'fetch_info': {
-                'timestamp': datetime.now().isoformat(),
+                'timestamp': run_time.isoformat(),
                 'total_records': len(sleep_records)
             },
             'sleep_records': sleep_records
         }
         
-        with open(json_filename, 'w') as f:
-            json.dump(json_data, f, indent=2)
+        with open(json_filename, 'wb') as f:
+            f.write(orjson.dumps(json_data, option=orjson.OPT_INDENT_2))
         
         print(f"✅ JSON data saved: {json_filename}")
         
@@ -292,39 +324,7 @@ def main():
         print(f"📁 JSON file: {json_filename}")
         
         # Basic analysis
-        if sleep_records:
-            print(f"\n📈 Basic Analysis:")
-            
-            # Calculate average sleep duration
-            total_duration = 0
-            total_score = 0
-            valid_scores = 0
-            
-            for record in sleep_records:
-                # Calculate sleep score
-                if 'score' in record and record['score']:
-                    score = record['score'].get('sleep_performance_percentage')
-                    if score is not None:
-                        total_score += score
-                        valid_scores += 1
-                
-                # Calculate duration from start/end times
-                if 'start' in record and 'end' in record:
-                    try:
-                        start_time = datetime.fromisoformat(record['start'].replace('Z', '+00:00'))
-                        end_time = datetime.fromisoformat(record['end'].replace('Z', '+00:00'))
-                        duration = (end_time - start_time).total_seconds() / 3600
-                        total_duration += duration
-                    except:
-                        pass
-            
-            if len(sleep_records) > 0:
-                avg_duration = total_duration / len(sleep_records)
-                print(f"   Average sleep duration: {avg_duration:.2f} hours")
-            
-            if valid_scores > 0:
-                avg_score = total_score / valid_scores
-                print(f"   Average sleep score: {avg_score:.1f}%")
+        print_sleep_analysis(sleep_records)
     
     else:
         print("❌ No sleep data retrieved")
@@ -1,14 +1,29 @@
-import json
 import csv
 import os
-import glob
+import re
+import shutil
+import orjson
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
+from itertools import islice
+
+# Set WHOOP_DEBUG=1 to print the score field breakdown while combining
+DEBUG_SCORE_FIELDS = bool(os.getenv('WHOOP_DEBUG'))
+
+# Export files written by the batch and custom fetchers
+SLEEP_JSON_PATTERN = re.compile(r'sleep_data_(batch|custom)_.*\.json$')
+
+# Worker processes expanding files, and how many files may be in flight at once;
+# the cap keeps finished results from piling up while the writer catches up
+MAX_EXPAND_WORKERS = os.cpu_count() or 1
+MAX_FILES_IN_FLIGHT = 2 * MAX_EXPAND_WORKERS
 
 def load_json_file(filepath):
     """Load a JSON file and return the data"""
     try:
-        with open(filepath, 'r', encoding='utf-8') as f:
-            return json.load(f)
+        with open(filepath, 'rb') as f:
+            return orjson.loads(f.read())
     except Exception as e:
         print(f"❌ Error loading {filepath}: {e}")
         return None
@@ -34,27 +49,9 @@ def expand_nested_fields(record):
                 # For other nested dictionaries, use underscore separator
                 for nested_key, nested_value in value.items():
                     expanded_record[f"{key}_{nested_key}"] = nested_value
-        elif isinstance(value, str):
-            # Try to parse as JSON if it's a string (for score fields)
-            if key in ['score_sleep_needed', 'score_stage_summary']:
-                try:
-                    parsed = json.loads(value)
-                    if isinstance(parsed, dict):
-                        # Expand the parsed JSON dictionary
-                        for nested_key, nested_value in parsed.items():
-                            expanded_record[f"{key}.{nested_key}"] = nested_value
-                    else:
-                        # Keep original value if not a dict
-                        expanded_record[key] = value
-                except json.JSONDecodeError:
-                    # Keep original value if not valid JSON
-                    expanded_record[key] = value
-            else:
-                # For other strings, keep as is
-                expanded_record[key] = value
         elif isinstance(value, list):
             # Convert lists to JSON strings
-            expanded_record[key] = json.dumps(value)
+            expanded_record[key] = orjson.dumps(value).decode()
         else:
             expanded_record[key] = value
     
@@ -84,37 +81,41 @@ def debug_score_fields(records):
             print(f"   String length: {len(value)}")
             # Try to parse as JSON
             try:
-                parsed = json.loads(value)
+                parsed = orjson.loads(value)
                 print(f"   Parsed JSON type: {type(parsed)}")
                 if isinstance(parsed, dict):
                     print(f"   Parsed JSON keys: {list(parsed.keys())}")
-            except json.JSONDecodeError:
+            except orjson.JSONDecodeError:
                 print(f"   Not valid JSON")
 
-def process_sleep_json_file(filepath):
-    """Process a single sleep JSON file and return expanded records"""
-    print(f"📁 Processing: {os.path.basename(filepath)}")
+def process_sleep_json_file(filepath, verbose=True):
+    """Process a single sleep JSON file and return its expanded records and column names"""
+    if verbose:
+        print(f"📁 Processing: {os.path.basename(filepath)}")
     
     data = load_json_file(filepath)
     if not data:
-        return []
+        return [], set()
     
     # Extract user info and sleep records
     user_info = data.get('user_info', {})
     sleep_records = data.get('sleep_records', [])
     
     if not sleep_records:
-        print(f"  ⚠️  No sleep records found")
-        return []
+        if verbose:
+            print(f"  ⚠️  No sleep records found")
+        return [], set()
     
-    print(f"  📊 Found {len(sleep_records)} sleep records")
+    if verbose:
+        print(f"  📊 Found {len(sleep_records)} sleep records")
     
     # Debug score fields for the first file
-    if "jackfrankandrew" in filepath:  # Only debug for one user to avoid spam
+    if verbose and DEBUG_SCORE_FIELDS and "jackfrankandrew" in filepath:  # Only debug for one user to avoid spam
         debug_score_fields(sleep_records)
     
-    # Expand each record
+    # Expand each record, collecting the column names as we go
     expanded_records = []
+    fieldnames = set()
     for record in sleep_records:
         expanded_record = expand_nested_fields(record)
         
@@ -126,32 +127,59 @@ def process_sleep_json_file(filepath):
             'source_file': os.path.basename(filepath)
         })
         
+        fieldnames.update(expanded_record)
         expanded_records.append(expanded_record)
     
-    print(f"  ✅ Expanded to {len(expanded_records)} records")
-    return expanded_records
+    if verbose:
+        print(f"  ✅ Expanded to {len(expanded_records)} records")
+    return expanded_records, fieldnames
+
+def get_file_rows(filepath, verbose=True):
+    """Expand one sleep JSON file into its sorted column names and positional rows"""
+    expanded_records, fieldnames = process_sleep_json_file(filepath, verbose)
+    fieldnames = sorted(fieldnames)
+    return fieldnames, [tuple(record.get(field, '') for field in fieldnames) for record in expanded_records]
+
+def iter_file_rows(json_files, verbose=True):
+    """Yield each file's column names and rows in file order, one file at a time"""
+    # Files are independent and expanding them is CPU-bound, so spread them over
+    # worker processes, submitting a new file only as an earlier one is taken
+    files = iter(json_files)
+    with ProcessPoolExecutor(max_workers=MAX_EXPAND_WORKERS) as executor:
+        pending = deque(executor.submit(get_file_rows, filepath, verbose)
+                        for filepath in islice(files, MAX_FILES_IN_FLIGHT))
+        while pending:
+            result = pending.popleft().result()
+            for filepath in islice(files, 1):
+                pending.append(executor.submit(get_file_rows, filepath, verbose))
+            yield result
+
+def scan_sleep_json_files(directory):
+    """List batch and custom sleep JSON files in a directory with one scandir pass"""
+    files_by_kind = {'batch': [], 'custom': []}
+    
+    try:
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                match = SLEEP_JSON_PATTERN.match(entry.name)
+                if match and entry.is_file():
+                    files_by_kind[match.group(1)].append(entry.path)
+    except FileNotFoundError:
+        pass
+    
+    return files_by_kind['batch'], files_by_kind['custom']
 
 def find_sleep_json_files():
     """Find all sleep data JSON files"""
-    # Look for batch sleep data files in exports/json/
-    pattern = os.path.join("exports", "json", "sleep_data_batch_*.json")
-    files = glob.glob(pattern)
-    
-    if not files:
-        # Also look for custom sleep data files in exports/json/
-        pattern = os.path.join("exports", "json", "sleep_data_custom_*.json")
-        files = glob.glob(pattern)
-    
-    if not files:
-        # Fallback: look in current directory
-        pattern = "sleep_data_batch_*.json"
-        files = glob.glob(pattern)
-        
-        if not files:
-            pattern = "sleep_data_custom_*.json"
-            files = glob.glob(pattern)
+    # Look in exports/json/ first, then fall back to the current directory;
+    # in each location batch files take precedence over custom files
+    for directory in (os.path.join("exports", "json"), "."):
+        batch_files, custom_files = scan_sleep_json_files(directory)
+        files = batch_files or custom_files
+        if files:
+            return sorted(files)
     
-    return sorted(files)
+    return []
 
 def ensure_output_directory():
     """Ensure the combined_csv output directory exists"""
@@ -161,12 +189,28 @@ def ensure_output_directory():
         print(f"Created combined_csv directory: {output_dir}")
     return output_dir
 
-def get_all_fieldnames(records):
-    """Get all unique field names from all records"""
-    fieldnames = set()
-    for record in records:
-        fieldnames.update(record.keys())
-    return sorted(list(fieldnames))
+def write_combined_csv(output_file, spool_file, fieldnames, spooled_files):
+    """Write the header and every spooled file's rows, widened to fieldnames where needed"""
+    with open(output_file, 'w', newline='', encoding='utf-8') as csvfile, \
+         open(spool_file, 'r', newline='', encoding='utf-8') as spool:
+        writer = csv.writer(csvfile)
+        writer.writerow(fieldnames)
+        
+        # Files normally share one schema, in which case the spool already
+        # holds the final rows and is copied over as it is
+        if all(file_fieldnames == fieldnames for file_fieldnames, _ in spooled_files):
+            csvfile.flush()
+            shutil.copyfileobj(spool, csvfile)
+            return
+        
+        reader = csv.reader(spool)
+        for file_fieldnames, row_count in spooled_files:
+            rows = islice(reader, row_count)
+            if file_fieldnames != fieldnames:
+                positions = {field: index for index, field in enumerate(file_fieldnames)}
+                order = [positions.get(field) for field in fieldnames]
+                rows = (['' if index is None else row[index] for index in order] for row in rows)
+            writer.writerows(rows)
 
 def main():
     """Main function to expand and combine sleep data"""
@@ -186,40 +230,51 @@ def main():
     
     print(f"📋 Found {len(json_files)} JSON files to process")
     
-    # Process all files and collect expanded records
-    all_records = []
-    for filepath in json_files:
-        records = process_sleep_json_file(filepath)
-        all_records.extend(records)
-    
-    if not all_records:
-        print("❌ No records to export")
-        return
-    
-    print(f"\n📊 Total expanded records: {len(all_records)}")
-    
-    # Get all field names
-    fieldnames = get_all_fieldnames(all_records)
-    print(f"📋 Total columns: {len(fieldnames)}")
-    
     # Create output filename in the combined_csv directory
     timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
     output_file = os.path.join(output_dir, f"combined_sleep_data_expanded_{timestamp}.csv")
+    spool_file = f"{output_file}.tmp"
     
-    # Write to CSV
-    print(f"\n💾 Writing to: {output_file}")
-    with open(output_file, 'w', newline='', encoding='utf-8') as csvfile:
-        writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-        writer.writeheader()
-        writer.writerows(all_records)
+    # Each file is expanded once and its rows spooled under its own columns as
+    # they arrive, so only the files in flight are ever held in memory; the
+    # header, which needs every file's columns, is only known at the end
+    all_fieldnames = set()
+    spooled_files = []
+    record_count = 0
+    users = set()
+    try:
+        with open(spool_file, 'w', newline='', encoding='utf-8') as spool:
+            writer = csv.writer(spool)
+            for file_fieldnames, rows in iter_file_rows(json_files):
+                if not rows:
+                    continue
+                writer.writerows(rows)
+                spooled_files.append((file_fieldnames, len(rows)))
+                all_fieldnames.update(file_fieldnames)
+                record_count += len(rows)
+                email_index = file_fieldnames.index('user_email')
+                users.update(row[email_index] for row in rows)
+        
+        if not all_fieldnames:
+            print("❌ No records to export")
+            return
+        
+        fieldnames = sorted(all_fieldnames)
+        print(f"📋 Total columns: {len(fieldnames)}")
+        
+        print(f"\n💾 Writing to: {output_file}")
+        write_combined_csv(output_file, spool_file, fieldnames, spooled_files)
+    finally:
+        if os.path.exists(spool_file):
+            os.remove(spool_file)
     
-    print(f"✅ Successfully exported {len(all_records)} records to {output_file}")
+    print(f"✅ Successfully exported {record_count} records to {output_file}")
     
     # Show some statistics
     print(f"\n📈 Summary:")
-    print(f"   Total records: {len(all_records)}")
+    print(f"   Total records: {record_count}")
     print(f"   Total columns: {len(fieldnames)}")
-    print(f"   Users: {len(set(record['user_email'] for record in all_records))}")
+    print(f"   Users: {len(users)}")
     
     # Show expanded columns
     expanded_columns = [col for col in fieldnames if '.' in col]
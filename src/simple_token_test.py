@@ -1,5 +1,6 @@
 import json
 import os
+import orjson
 import requests
 from dotenv import load_dotenv
 
@@ -52,7 +53,7 @@ def test_token_refresh():
         print(f"Response status: {response.status_code}")
         
         if response.status_code == 200:
-            token_response = response.json()
+            token_response = orjson.loads(response.content)
             print(f"✅ SUCCESS!")
             print(f"New access token: {token_response.get('access_token', '')[:20]}...")
             print(f"New refresh token: {token_response.get('refresh_token', '')[:20]}...")
@@ -111,6 +111,7 @@ def refresh_user_token_batch(credentials):
                 "refresh_token": token_response.get('refresh_token', credentials.get('refresh_token')),
                 "expires_in": expires_in,
                 "expires_at": expires_at.isoformat(),
+                "expires_at_ts": expires_at.timestamp(),
                 "token_type": token_response.get('token_type', 'bearer'),
                 "last_refreshed": datetime.now().isoformat()
             })
@@ -125,7 +126,7 @@ def refresh_user_token_batch(credentials):
                 error_data = response.json()
                 print(f"  Error details: {error_data}")
             except:
-                print(f"  Raw response: {response.text[:200]}")
+                print(f"  Raw response: {response.content[:200].decode('utf-8', errors='replace')}")
             return False
             
     except Exception as e:
@@ -217,8 +218,8 @@ def flatten_sleep_record(record):
             # Expand score fields
             for score_key, score_value in value.items():
                 if isinstance(score_value, dict):
-                    # Convert nested dict to string representation
-                    flat_record[f'score_{score_key}'] = str(score_value)
+                    # Store nested dicts as compact JSON, like the other exporters
+                    flat_record[f'score_{score_key}'] = json.dumps(score_value, separators=(',', ':'))
                 else:
                     flat_record[f'score_{score_key}'] = score_value
         else:
@@ -305,7 +306,7 @@ def fetch_new_sleep_data(credentials, start_date, days_back=7):
                     error_data = response.json()
                     print(f"      Error details: {error_data}")
                 except:
-                    print(f"      Raw response: {response.text[:200]}")
+                    print(f"      Raw response: {response.content[:200].decode('utf-8', errors='replace')}")
                 print(f"      Request params: {current_params}")
                 return None
                 
@@ -336,11 +337,11 @@ def append_to_csv(csv_file, new_records, user_email):
         flat_record['user_email'] = user_email
         flattened_records.append(flat_record)
     
-    # Get all field names (existing + new)
-    all_fieldnames = set(existing_fieldnames) if existing_fieldnames else set()
+    # Get all field names (existing first, then any new keys in first-seen order)
+    fieldname_order = dict.fromkeys(existing_fieldnames or [])
     for record in flattened_records:
-        all_fieldnames.update(record.keys())
-    all_fieldnames = sorted(list(all_fieldnames))
+        fieldname_order.update(dict.fromkeys(record))
+    all_fieldnames = list(fieldname_order)
     
     # Append to CSV
     mode = 'a' if os.path.exists(csv_file) else 'w'
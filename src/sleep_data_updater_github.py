@@ -1,13 +1,88 @@
 import json
 import csv
 import os
-import requests
+import orjson
 import glob
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime, timedelta
 from dotenv import load_dotenv
+from whoop_common import (
+    create_session, get_expires_at_ts, get_retry_delay, MAX_RATE_LIMIT_RETRIES,
+    SLEEP_FIELDNAMES, SAFE_EMAIL_TABLE, flatten_sleep_record
+)
 
 load_dotenv()
 
+# WHOOP app credentials, read once rather than on every token refresh
+WHOOP_CLIENT_ID = os.getenv('WHOOP_CLIENT_ID')
+WHOOP_CLIENT_SECRET = os.getenv('WHOOP_CLIENT_SECRET')
+WHOOP_REDIRECT_URI = os.getenv('WHOOP_REDIRECT_URI')
+
+# WHOOP API endpoints
+TOKEN_URL = "https://api.prod.whoop.com/oauth/oauth2/token"
+SLEEP_URL = "https://api.prod.whoop.com/developer/v2/activity/sleep"
+
+class TokenBucket:
+    """Thread-safe token bucket that spaces out requests to the WHOOP API"""
+    
+    def __init__(self, rate, capacity):
+        self.rate = rate  # tokens added per second
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+    
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+    
+    def acquire(self):
+        """Block until one more request may be sent"""
+        with self.lock:
+            self._refill()
+            # Take the token now, even on credit, and sleep off the debt outside
+            # the lock so waiting threads are released in order
+            self.tokens -= 1
+            wait_seconds = -self.tokens / self.rate if self.tokens < 0 else 0
+        
+        if wait_seconds:
+            time.sleep(wait_seconds)
+    
+    def drain(self, seconds):
+        """Empty the bucket so no request goes out for the given number of seconds"""
+        with self.lock:
+            self._refill()
+            self.tokens = min(self.tokens, -seconds * self.rate)
+
+# Every call goes to api.prod.whoop.com, so one session lets token checks,
+# refreshes and sleep pages for all users reuse the same connections
+SESSION = create_session()
+
+# Users updated at once; well under the session's connection pool size
+MAX_USER_WORKERS = 8
+
+# WHOOP allows 100 requests per minute per app; all worker threads share one
+# bucket so together they stay under it, with only a small burst allowed
+WHOOP_REQUESTS_PER_MINUTE = 100
+RATE_LIMITER = TokenBucket(rate=WHOOP_REQUESTS_PER_MINUTE / 60, capacity=10)
+
+# CSVs up to this size are scanned in full for the latest date; larger ones
+# only have their first data row and last block read
+CSV_FULL_SCAN_BYTES = 64 * 1024
+CSV_TAIL_BYTES = 64 * 1024
+
+# Write buffer for CSV appends and rewrites, so a batch reaches disk in a few large writes
+CSV_WRITE_BUFFER_BYTES = 1 << 20
+
+# Tokens this close to expiry (in seconds) are refreshed before use
+TOKEN_EXPIRY_BUFFER_SECONDS = 5 * 60
+
+class TokenRejectedError(Exception):
+    """Raised when WHOOP answers a sleep request with 401 Unauthorized"""
+
 def ensure_data_directory():
     """Ensure the data directory exists"""
     data_dir = "data"
@@ -31,16 +106,15 @@ def load_batch_credentials():
 
 def is_token_expired(credentials):
     """Check if token is expired or will expire soon (within 5 minutes)"""
-    if 'expires_at' not in credentials:
+    # Derived from expires_at whenever it is present, since the secret may
+    # carry an expires_at_ts left stale by a script that only updated the ISO string
+    expires_at_ts = get_expires_at_ts(credentials)
+    if expires_at_ts is None:
         return True
+    credentials['expires_at_ts'] = expires_at_ts
     
-    try:
-        expires_at = datetime.fromisoformat(credentials['expires_at'])
-        # Consider token expired if it expires within 5 minutes
-        buffer_time = timedelta(minutes=5)
-        return datetime.now() + buffer_time >= expires_at
-    except:
-        return True
+    # Consider token expired if it expires within 5 minutes
+    return time.time() + TOKEN_EXPIRY_BUFFER_SECONDS >= credentials['expires_at_ts']
 
 def refresh_user_token_batch(credentials):
     """Refresh access token for batch users using the same logic as token_refresh_handler"""
@@ -50,36 +124,30 @@ def refresh_user_token_batch(credentials):
         print("  ❌ No refresh token available")
         return False
     
-    # Get environment variables
-    client_id = os.getenv('WHOOP_CLIENT_ID')
-    client_secret = os.getenv('WHOOP_CLIENT_SECRET')
-    redirect_uri = os.getenv('WHOOP_REDIRECT_URI')
-    
-    if not all([client_id, client_secret, redirect_uri]):
+    if not all([WHOOP_CLIENT_ID, WHOOP_CLIENT_SECRET, WHOOP_REDIRECT_URI]):
         print("  ❌ Missing environment variables for token refresh")
         return False
     
-    # WHOOP token refresh endpoint
-    token_url = "https://api.prod.whoop.com/oauth/oauth2/token"
-    
     # Prepare refresh request (following WHOOP API documentation)
     refresh_data = {
         "grant_type": "refresh_token",
-        "client_id": client_id,
-        "client_secret": client_secret,
+        "client_id": WHOOP_CLIENT_ID,
+        "client_secret": WHOOP_CLIENT_SECRET,
         "scope": "offline",  # Required for refresh token flow
         "refresh_token": credentials['refresh_token']
     }
     
     try:
-        response = requests.post(token_url, data=refresh_data)
+        RATE_LIMITER.acquire()
+        response = SESSION.post(TOKEN_URL, data=refresh_data)
         
         if response.status_code == 200:
-            token_response = response.json()
+            token_response = orjson.loads(response.content)
             
             # Calculate new expiration time
             expires_in = token_response.get('expires_in', 3600)
-            expires_at = datetime.now() + timedelta(seconds=expires_in)
+            refreshed_at = datetime.now()
+            expires_at = refreshed_at + timedelta(seconds=expires_in)
             
             # Update credentials
             credentials.update({
@@ -87,13 +155,13 @@ def refresh_user_token_batch(credentials):
                 "refresh_token": token_response.get('refresh_token', credentials.get('refresh_token')),
                 "expires_in": expires_in,
                 "expires_at": expires_at.isoformat(),
+                "expires_at_ts": expires_at.timestamp(),
                 "token_type": token_response.get('token_type', 'bearer'),
-                "last_refreshed": datetime.now().isoformat()
+                "last_refreshed": refreshed_at.isoformat()
             })
             
             print("  ✅ Token refreshed successfully!")
             print(f"  📅 New expiration: {expires_at}")
-            print("  🔄 Credentials will be automatically updated in GitHub Secrets")
             return True
             
         else:
@@ -102,113 +170,81 @@ def refresh_user_token_batch(credentials):
                 error_data = response.json()
                 print(f"  Error details: {error_data}")
             except:
-                print(f"  Raw response: {response.text[:200]}")
+                print(f"  Raw response: {response.content[:200].decode('utf-8', errors='replace')}")
             return False
             
     except Exception as e:
         print(f"  ❌ Exception during token refresh: {e}")
         return False
 
-def test_user_token(credentials):
-    """Test if user token is valid"""
-    headers = {
-        "Authorization": f"Bearer {credentials['access_token']}",
-        "Content-Type": "application/json"
-    }
-    
-    profile_url = "https://api.prod.whoop.com/developer/v2/user/profile/basic"
-    
-    try:
-        response = requests.get(profile_url, headers=headers)
-        return response.status_code == 200
-    except:
-        return False
-
-def check_token_validity(credentials):
-    """Check if token is still valid without refreshing"""
-    if not credentials.get('access_token'):
-        return False
-    
-    headers = {
-        "Authorization": f"Bearer {credentials['access_token']}",
-        "Content-Type": "application/json"
-    }
-    
-    profile_url = "https://api.prod.whoop.com/developer/v2/user/profile/basic"
-    
-    try:
-        response = requests.get(profile_url, headers=headers)
-        return response.status_code == 200
-    except:
-        return False
-
 def find_user_csv_file(user_email):
     """Find the CSV file for a specific user in the data directory"""
-    data_dir = "data"
-    filename = f"sleep_data_batch_{user_email.replace('@', '_at_').replace('.', '_')}.csv"
-    filepath = os.path.join(data_dir, filename)
-    
-    if os.path.exists(filepath):
-        return filepath
-    else:
-        # Return the path even if file doesn't exist (will be created)
-        return filepath
+    # Return the path even if file doesn't exist (will be created)
+    filename = f"sleep_data_batch_{user_email.translate(SAFE_EMAIL_TABLE)}.csv"
+    return os.path.join("data", filename)
 
 def get_latest_date_from_csv(csv_file):
     """Get the latest date from a CSV file"""
     if not os.path.exists(csv_file):
         return None
     
-    latest_date = None
-    
     try:
-        with open(csv_file, 'r', newline='', encoding='utf-8') as f:
-            reader = csv.DictReader(f)
+        with open(csv_file, 'rb') as f:
+            header = next(csv.reader([f.readline().decode('utf-8')]), [])
+            if 'start' not in header:
+                return None
+            start_index = header.index('start')
+            
+            # The original export is newest-first and each update appends its batch
+            # after it, so the newest start is either in the first data row or near
+            # the end; small files are simply scanned in full
+            first_row = next(csv.reader([f.readline().decode('utf-8')]), [])
+            first_start = first_row[start_index] if len(first_row) > start_index else ''
+            body_start = f.tell()
+            file_size = f.seek(0, os.SEEK_END)
+            tail_bytes = CSV_TAIL_BYTES if file_size > CSV_FULL_SCAN_BYTES else file_size
             
-            for row in reader:
-                if 'start' in row and row['start']:
-                    try:
-                        # Parse the start date (ISO format)
-                        date_str = row['start'].replace('Z', '+00:00')
-                        record_date = datetime.fromisoformat(date_str)
-                        
-                        if latest_date is None or record_date > latest_date:
-                            latest_date = record_date
-                    except:
-                        continue
-                        
+            while True:
+                window_start = max(body_start, file_size - tail_bytes)
+                f.seek(window_start)
+                tail = f.read()
+                if window_start > body_start:
+                    # Drop the partial line the block starts in the middle of
+                    tail = tail[tail.find(b'\n') + 1:]
+                
+                # WHOOP timestamps share one UTC format (e.g. 2025-08-04T21:50:54.123Z),
+                # so the latest start is simply the largest string
+                starts = [row[start_index] for row in csv.reader(tail.decode('utf-8').splitlines())
+                          if len(row) > start_index and row[start_index]]
+                
+                # Appended batches are newest-first as well, so a maximum on the
+                # block's first row may belong to a batch that began further back;
+                # widen the block until it reaches that batch's start, unless the
+                # block already starts within the original export
+                if (window_start == body_start or not starts or max(starts) != starts[0]
+                        or starts[0] <= first_start):
+                    break
+                tail_bytes *= 2
     except Exception as e:
         print(f"  ❌ Error reading CSV file: {e}")
         return None
     
-    return latest_date
-
-def flatten_sleep_record(record):
-    """Flatten a sleep record for CSV export with expanded nested fields"""
-    flat_record = {}
-    
-    # Basic fields
-    for key, value in record.items():
-        if key == 'score' and isinstance(value, dict):
-            # Expand score fields
-            for score_key, score_value in value.items():
-                if isinstance(score_value, dict):
-                    # Convert nested dict to string representation
-                    flat_record[f'score_{score_key}'] = str(score_value)
-                else:
-                    flat_record[f'score_{score_key}'] = score_value
-        else:
-            flat_record[key] = value
+    if first_start:
+        starts.append(first_start)
+    
+    # Only the latest start needs parsing
+    latest_start = max(starts, default=None)
+    if latest_start is None:
+        return None
     
-    return flat_record
+    try:
+        return datetime.fromisoformat(latest_start)
+    except ValueError:
+        print(f"  ❌ Unrecognised start date in CSV: {latest_start}")
+        return None
 
 def fetch_new_sleep_data(credentials, start_date, days_back=7):
     """Fetch new sleep data from WHOOP API"""
-    print(f"  📅 Fetching data from {start_date.strftime('%Y-%m-%d')} onwards...")
-    
-    # WHOOP API endpoint
-    endpoint = "https://api.prod.whoop.com/developer/v2/activity/sleep"
-    
     headers = {
         "Authorization": f"Bearer {credentials['access_token']}",
         "Content-Type": "application/json"
@@ -223,9 +259,13 @@ def fetch_new_sleep_data(credentials, start_date, days_back=7):
         # If no start date, fetch last 7 days
         start_date = end_date - timedelta(days=days_back)
     
-    # Format dates for API (milliseconds format required by WHOOP API)
-    start_str = start_date.strftime('%Y-%m-%dT%H:%M:%S.%fZ')[:-4] + 'Z'
-    end_str = end_date.strftime('%Y-%m-%dT%H:%M:%S.%fZ')[:-4] + 'Z'
+    # Reported only now that start_date is set; a user without a CSV yet arrives with None
+    print(f"  📅 Fetching data from {start_date.strftime('%Y-%m-%d')} onwards...")
+    
+    # Format dates for API (milliseconds format required by WHOOP API); CSV dates
+    # carry a UTC offset, which is dropped so both end in a plain 'Z'
+    start_str = start_date.replace(tzinfo=None).isoformat(timespec='milliseconds') + 'Z'
+    end_str = end_date.isoformat(timespec='milliseconds') + 'Z'
     
     params = {
         'start': start_str,
@@ -236,20 +276,26 @@ def fetch_new_sleep_data(credentials, start_date, days_back=7):
     all_records = []
     next_token = None
     page_count = 0
+    rate_limited_attempts = 0
     
     while True:
-        page_count += 1
-        print(f"    📄 Fetching page {page_count}...")
+        # A rate-limited retry asks for the same page again, so only a new page is counted
+        if not rate_limited_attempts:
+            page_count += 1
+            print(f"    📄 Fetching page {page_count}...")
         
-        current_params = params.copy()
+        # The same params dict is reused for every page; only the token changes
         if next_token:
-            current_params['nextToken'] = next_token
+            params['nextToken'] = next_token
             
         try:
-            response = requests.get(endpoint, headers=headers, params=current_params)
+            RATE_LIMITER.acquire()
+            response = SESSION.get(SLEEP_URL, headers=headers, params=params)
             
             if response.status_code == 200:
-                data = response.json()
+                rate_limited_attempts = 0
+                # Parse the raw body with orjson instead of requests' stdlib decoder
+                data = orjson.loads(response.content)
                 records = data.get('records', [])
                 
                 if records:
@@ -266,14 +312,19 @@ def fetch_new_sleep_data(credentials, start_date, days_back=7):
                     
             elif response.status_code == 401:
                 print("      ❌ 401: Unauthorized - Token may be expired")
-                return None
+                raise TokenRejectedError()
             elif response.status_code == 403:
                 print("      ❌ 403: Forbidden - Check app permissions")
                 return None
             elif response.status_code == 429:
-                print("      ❌ 429: Rate Limited - Waiting 60 seconds...")
-                import time
-                time.sleep(60)
+                if rate_limited_attempts >= MAX_RATE_LIMIT_RETRIES:
+                    print(f"      ❌ 429: Rate Limited - Giving up after {rate_limited_attempts} retries")
+                    return None
+                # Hold back every thread for as long as WHOOP asks, not just this one
+                wait_seconds = get_retry_delay(response, rate_limited_attempts)
+                rate_limited_attempts += 1
+                print(f"      ❌ 429: Rate Limited - Waiting {wait_seconds:.0f} seconds...")
+                RATE_LIMITER.drain(wait_seconds)
                 continue
             else:
                 print(f"      ❌ {response.status_code}: Unexpected status")
@@ -281,10 +332,12 @@ def fetch_new_sleep_data(credentials, start_date, days_back=7):
                     error_data = response.json()
                     print(f"      Error details: {error_data}")
                 except:
-                    print(f"      Raw response: {response.text[:200]}")
-                print(f"      Request params: {current_params}")
+                    print(f"      Raw response: {response.content[:200].decode('utf-8', errors='replace')}")
+                print(f"      Request params: {params}")
                 return None
                 
+        except TokenRejectedError:
+            raise
         except Exception as e:
             print(f"      ❌ Request failed: {e}")
             return None
@@ -292,48 +345,62 @@ def fetch_new_sleep_data(credentials, start_date, days_back=7):
     print(f"  ✅ Total new records fetched: {len(all_records)}")
     return all_records
 
+def read_csv_header(csv_file):
+    """Read only the header row of a CSV file"""
+    with open(csv_file, 'r', newline='', encoding='utf-8') as f:
+        return next(csv.reader(f), [])
+
+def rewrite_csv_with_fieldnames(csv_file, fieldnames):
+    """Rewrite an existing CSV under a wider header, filling new columns with blanks"""
+    temp_file = f"{csv_file}.tmp"
+    with open(csv_file, 'r', newline='', encoding='utf-8') as src, \
+         open(temp_file, 'w', buffering=CSV_WRITE_BUFFER_BYTES, newline='', encoding='utf-8') as dst:
+        writer = csv.DictWriter(dst, fieldnames=fieldnames, restval='')
+        writer.writeheader()
+        writer.writerows(csv.DictReader(src))
+    # Swap the file in only once it is complete so an interrupted run leaves the old CSV intact
+    os.replace(temp_file, csv_file)
+
 def append_to_csv(csv_file, new_records, user_email):
     """Append new records to existing CSV file"""
     if not new_records:
         print("  ⚠️  No new records to append")
         return
     
-    # Read existing fieldnames
-    existing_fieldnames = []
-    if os.path.exists(csv_file):
-        with open(csv_file, 'r', newline='', encoding='utf-8') as f:
-            reader = csv.DictReader(f)
-            existing_fieldnames = reader.fieldnames
-    
-    # Flatten new records
-    flattened_records = []
-    for record in new_records:
-        flat_record = flatten_sleep_record(record)
-        flat_record['user_email'] = user_email
-        flattened_records.append(flat_record)
-    
-    # Get all field names (existing + new)
-    all_fieldnames = set(existing_fieldnames) if existing_fieldnames else set()
-    for record in flattened_records:
-        all_fieldnames.update(record.keys())
-    all_fieldnames = sorted(list(all_fieldnames))
+    # Only the header line is needed from the existing file
+    file_exists = os.path.exists(csv_file)
+    fieldnames = read_csv_header(csv_file) if file_exists else SLEEP_FIELDNAMES
+    
+    # Build positional rows up front so the whole batch goes to the C writer at once
+    rows = [flatten_sleep_record(record, user_email) for record in new_records]
+    
+    # Files written by the fetchers already use SLEEP_FIELDNAMES, so their rows go in
+    # as they are. Any other layout keeps its column order; a missing column forces a
+    # one-off rewrite, since appending rows under a header that lacks it would corrupt the file
+    if fieldnames != SLEEP_FIELDNAMES:
+        missing = set(SLEEP_FIELDNAMES).difference(fieldnames)
+        if missing:
+            fieldnames = sorted(missing.union(fieldnames))
+            print(f"  🔧 Adding new columns to {csv_file}: {', '.join(sorted(missing))}")
+            rewrite_csv_with_fieldnames(csv_file, fieldnames)
+        
+        positions = {field: index for index, field in enumerate(SLEEP_FIELDNAMES)}
+        order = [positions.get(field) for field in fieldnames]
+        rows = [['' if index is None else row[index] for index in order] for row in rows]
     
     # Append to CSV
-    mode = 'a' if os.path.exists(csv_file) else 'w'
-    with open(csv_file, mode, newline='', encoding='utf-8') as csvfile:
-        writer = csv.DictWriter(csvfile, fieldnames=all_fieldnames)
+    mode = 'a' if file_exists else 'w'
+    with open(csv_file, mode, buffering=CSV_WRITE_BUFFER_BYTES, newline='', encoding='utf-8') as csvfile:
+        writer = csv.writer(csvfile)
         
         # Write header only if creating new file
         if mode == 'w':
-            writer.writeheader()
+            writer.writerow(fieldnames)
         
         # Write new records
-        for record in flattened_records:
-            # Ensure all fields are present
-            row = {field: record.get(field, '') for field in all_fieldnames}
-            writer.writerow(row)
+        writer.writerows(rows)
     
-    print(f"  ✅ Appended {len(flattened_records)} new records to {csv_file}")
+    print(f"  ✅ Appended {len(rows)} new records to {csv_file}")
 
 def save_updated_credentials(batch_credentials):
     """Save updated credentials to a file for GitHub Actions to update secrets"""
@@ -346,58 +413,69 @@ def save_updated_credentials(batch_credentials):
         print(f"  ❌ Error saving updated credentials: {e}")
         return False
 
-def update_user_sleep_data(user_email, user_credentials, batch_credentials):
+def refresh_user_credentials(user_credentials):
+    """Refresh a user's token, explaining how to recover when that fails"""
+    if refresh_user_token_batch(user_credentials):
+        return True
+    
+    print("  ❌ Token refresh failed.")
+    print("  💡 You may need to re-authenticate this user manually")
+    print("  ⏭️  Skipping user for now.")
+    return False
+
+def update_user_sleep_data(user_email, user_credentials, csv_file, csv_lock):
     """Update sleep data for a single user"""
     print(f"\n🔄 Processing user: {user_email}")
     
     credentials_updated = False
     
-    # First check if current token is still valid
-    if check_token_validity(user_credentials):
-        print("  ✅ Current token is still valid!")
-    elif is_token_expired(user_credentials):
+    # Trust the stored expiry instead of testing the token against the profile
+    # endpoint; a token rejected anyway is caught by the sleep fetch below
+    if is_token_expired(user_credentials):
         print("  ❌ Token has expired. Attempting automatic refresh...")
-        
-        # Use our batch-compatible token refresh function
-        if refresh_user_token_batch(user_credentials):
-            # Test the refreshed token
-            if test_user_token(user_credentials):
-                print("  ✅ Token refreshed successfully!")
-                credentials_updated = True
-            else:
-                print("  ❌ Refreshed token failed test.")
-                print("  💡 You may need to re-authenticate this user manually")
-                print("  ⏭️  Skipping user for now.")
-                return False, False
-        else:
-            print("  ❌ Token refresh failed.")
-            print("  💡 You may need to re-authenticate this user manually")
-            print("  ⏭️  Skipping user for now.")
+        if not refresh_user_credentials(user_credentials):
             return False, False
+        credentials_updated = True
     else:
-        time_left = datetime.fromisoformat(user_credentials['expires_at']) - datetime.now()
+        time_left = timedelta(seconds=int(user_credentials['expires_at_ts'] - time.time()))
         print(f"  ✅ Token valid for: {time_left}")
     
-    # Find existing CSV file
-    csv_file = find_user_csv_file(user_email)
     print(f"  📁 Using file: {csv_file}")
     
-    # Get latest date from CSV
-    latest_date = get_latest_date_from_csv(csv_file)
-    if latest_date:
-        print(f"  📅 Latest date in CSV: {latest_date.strftime('%Y-%m-%d %H:%M:%S')}")
-    else:
-        print("  ⚠️  Could not determine latest date from CSV")
-        latest_date = None
-    
-    # Fetch new data
-    new_records = fetch_new_sleep_data(user_credentials, latest_date)
-    if new_records is None:
-        print("  ❌ Failed to fetch new data")
-        return False, credentials_updated
-    
-    # Append new records to CSV
-    append_to_csv(csv_file, new_records, user_email)
+    # Emails that differ only in '.' vs '_' share a CSV file; such users take
+    # turns from reading its latest date until their rows are appended
+    with csv_lock:
+        # Get latest date from CSV
+        latest_date = get_latest_date_from_csv(csv_file)
+        if latest_date:
+            print(f"  📅 Latest date in CSV: {latest_date.strftime('%Y-%m-%d %H:%M:%S')}")
+        else:
+            print("  ⚠️  Could not determine latest date from CSV")
+            latest_date = None
+        
+        # Fetch new data
+        try:
+            new_records = fetch_new_sleep_data(user_credentials, latest_date)
+        except TokenRejectedError:
+            new_records = None
+            # A token that was not due to expire may still have been revoked;
+            # refresh it once and retry, unless it was only just refreshed
+            if not credentials_updated:
+                print("  🔄 Token was rejected. Attempting automatic refresh...")
+                if not refresh_user_credentials(user_credentials):
+                    return False, False
+                credentials_updated = True
+                try:
+                    new_records = fetch_new_sleep_data(user_credentials, latest_date)
+                except TokenRejectedError:
+                    pass
+        
+        if new_records is None:
+            print("  ❌ Failed to fetch new data")
+            return False, credentials_updated
+        
+        # Append new records to CSV
+        append_to_csv(csv_file, new_records, user_email)
     
     return True, credentials_updated
 
@@ -416,16 +494,33 @@ def main():
     
     print(f"📋 Found {len(batch_credentials)} users in batch credentials")
     
+    # Work out every user's CSV path once up front, with one lock per file
+    csv_paths = {user_email: find_user_csv_file(user_email) for user_email in batch_credentials}
+    csv_locks = {csv_file: threading.Lock() for csv_file in set(csv_paths.values())}
+    
     # Track results
     successful_users = []
     failed_users = []
-    any_credentials_updated = False
-    
-    # Process each user
-    for user_email, user_credentials in batch_credentials.items():
-        try:
-            # Process the user
-            success, credentials_updated = update_user_sleep_data(user_email, user_credentials, batch_credentials)
+    refreshed_users = []
+    
+    # Users are independent, so process them in parallel to overlap network waits;
+    # the shared rate limiter keeps their combined requests under WHOOP's limit
+    with ThreadPoolExecutor(max_workers=MAX_USER_WORKERS) as executor:
+        futures = {
+            executor.submit(
+                update_user_sleep_data, user_email, user_credentials,
+                csv_paths[user_email], csv_locks[csv_paths[user_email]]
+            ): user_email
+            for user_email, user_credentials in batch_credentials.items()
+        }
+        
+        for future in as_completed(futures):
+            user_email = futures[future]
+            try:
+                success, credentials_updated = future.result()
+            except Exception as e:
+                print(f"  ❌ Unexpected error processing {user_email}: {e}")
+                success, credentials_updated = False, False
             
             if success:
                 successful_users.append(user_email)
@@ -433,21 +528,12 @@ def main():
                 failed_users.append(user_email)
             
             if credentials_updated:
-                any_credentials_updated = True
-                
-        except Exception as e:
-            print(f"  ❌ Unexpected error processing {user_email}: {e}")
-            failed_users.append(user_email)
-        
-        # Add delay between users to avoid rate limiting
-        if len(batch_credentials) > 1:
-            print("  ⏳ Waiting 5 seconds before next user...")
-            import time
-            time.sleep(5)
-    
-    # Save updated credentials if any were refreshed
-    if any_credentials_updated:
-        print("\n🔄 Saving updated credentials for GitHub Secrets update...")
+                refreshed_users.append(user_email)
+    
+    # Save updated credentials once if any were refreshed; the workflow then
+    # updates the WHOOP_BATCH_CREDENTIALS secret from this file in a single gh call
+    if refreshed_users:
+        print(f"\n🔄 Saving refreshed credentials of {len(refreshed_users)} user(s) for GitHub Secrets update...")
         if save_updated_credentials(batch_credentials):
             print("✅ Updated credentials saved successfully!")
         else:
@@ -1,16 +1,26 @@
-import json
 import os
-import requests
+import orjson
+import time
 from datetime import datetime, timedelta
 from dotenv import load_dotenv
+from whoop_common import create_session, SERVER_ERROR_STATUSES, get_expires_at_ts, print_error_response, write_private_file
 
 load_dotenv()
 
+# Read the app credentials once at import instead of on every refresh
+WHOOP_CLIENT_ID = os.getenv('WHOOP_CLIENT_ID')
+WHOOP_CLIENT_SECRET = os.getenv('WHOOP_CLIENT_SECRET')
+WHOOP_REDIRECT_URI = os.getenv('WHOOP_REDIRECT_URI')
+
+# Refresh and test calls reuse one keep-alive connection to api.prod.whoop.com;
+# custom_sleep_fetcher imports these functions, so they share it there too
+SESSION = create_session(status_forcelist=(429,) + SERVER_ERROR_STATUSES)
+
 def load_credentials():
     """Load saved credentials"""
     try:
-        with open(".whoop_credentials.json", "r") as f:
-            return json.load(f)
+        with open(".whoop_credentials.json", "rb") as f:
+            return orjson.loads(f.read())
     except FileNotFoundError:
         print("❌ No credentials file found")
         return None
@@ -18,24 +28,32 @@ def load_credentials():
         print(f"❌ Error loading credentials: {e}")
         return None
 
+def read_file_bytes(path):
+    """Return a file's contents, or None if it does not exist"""
+    try:
+        with open(path, "rb") as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
 def save_credentials(credentials):
     """Save credentials to .whoop_credentials.json"""
-    with open(".whoop_credentials.json", "w") as f:
-        json.dump(credentials, f, indent=2)
+    data = orjson.dumps(credentials, option=orjson.OPT_INDENT_2)
+    if read_file_bytes(".whoop_credentials.json") == data:
+        print("✅ Credentials unchanged, .whoop_credentials.json not rewritten")
+        return
+    
+    write_private_file(".whoop_credentials.json", data)
     print("✅ Credentials saved to .whoop_credentials.json")
 
 def is_token_expired(credentials):
     """Check if token is expired or will expire soon (within 5 minutes)"""
-    if 'expires_at' not in credentials:
+    expires_at_ts = get_expires_at_ts(credentials)
+    if expires_at_ts is None:
         return True
     
-    try:
-        expires_at = datetime.fromisoformat(credentials['expires_at'])
-        # Consider token expired if it expires within 5 minutes
-        buffer_time = timedelta(minutes=5)
-        return datetime.now() + buffer_time >= expires_at
-    except:
-        return True
+    # Consider token expired if it expires within 5 minutes
+    return time.time() + 300 >= expires_at_ts
 
 def refresh_access_token(credentials):
     """Refresh access token using refresh token"""
@@ -45,12 +63,7 @@ def refresh_access_token(credentials):
         print("❌ No refresh token available")
         return False
     
-    # Get environment variables
-    client_id = os.getenv('WHOOP_CLIENT_ID')
-    client_secret = os.getenv('WHOOP_CLIENT_SECRET')
-    redirect_uri = os.getenv('WHOOP_REDIRECT_URI')
-    
-    if not all([client_id, client_secret, redirect_uri]):
+    if not all([WHOOP_CLIENT_ID, WHOOP_CLIENT_SECRET, WHOOP_REDIRECT_URI]):
         print("❌ Missing environment variables for token refresh")
         return False
     
@@ -60,14 +73,14 @@ def refresh_access_token(credentials):
     # Prepare refresh request
     refresh_data = {
         "grant_type": "refresh_token",
-        "client_id": client_id,
-        "client_secret": client_secret,
+        "client_id": WHOOP_CLIENT_ID,
+        "client_secret": WHOOP_CLIENT_SECRET,
         "refresh_token": credentials['refresh_token'],
-        "redirect_uri": redirect_uri
+        "redirect_uri": WHOOP_REDIRECT_URI
     }
     
     try:
-        response = requests.post(token_url, data=refresh_data)
+        response = SESSION.post(token_url, data=refresh_data)
         
         if response.status_code == 200:
             token_response = response.json()
@@ -82,6 +95,7 @@ def refresh_access_token(credentials):
                 "refresh_token": token_response.get('refresh_token', credentials.get('refresh_token')),
                 "expires_in": expires_in,
                 "expires_at": expires_at.isoformat(),
+                "expires_at_ts": expires_at.timestamp(),
                 "token_type": token_response.get('token_type', 'bearer'),
                 "last_refreshed": datetime.now().isoformat()
             })
@@ -95,11 +109,7 @@ def refresh_access_token(credentials):
             
         else:
             print(f"❌ Token refresh failed: {response.status_code}")
-            try:
-                error_data = response.json()
-                print(f"Error details: {error_data}")
-            except:
-                print(f"Raw response: {response.text[:200]}")
+            print_error_response(response)
             return False
             
     except Exception as e:
@@ -110,31 +120,29 @@ def test_token(credentials):
     """Test if the token is working"""
     print("🧪 Testing token...")
     
-    headers = {
-        "Authorization": f"Bearer {credentials['access_token']}",
-        "Content-Type": "application/json"
-    }
+    # GETs carry no body, so only the Authorization header is needed
+    headers = {"Authorization": f"Bearer {credentials['access_token']}"}
     
     # Test with user profile endpoint
     profile_url = "https://api.prod.whoop.com/developer/v2/user/profile/basic"
     
     try:
-        response = requests.get(profile_url, headers=headers)
-        
-        if response.status_code == 200:
-            profile_data = response.json()
-            print(f"✅ Token is valid!")
-            print(f"👤 User: {profile_data.get('first_name', 'Unknown')} {profile_data.get('last_name', 'Unknown')}")
-            return True
-        else:
-            print(f"❌ Token test failed: {response.status_code}")
-            return False
+        # Stream so a rejected token is reported without downloading the error body
+        with SESSION.get(profile_url, headers=headers, stream=True) as response:
+            if response.status_code == 200:
+                profile_data = orjson.loads(response.content)
+                print(f"✅ Token is valid!")
+                print(f"👤 User: {profile_data.get('first_name', 'Unknown')} {profile_data.get('last_name', 'Unknown')}")
+                return True
+            else:
+                print(f"❌ Token test failed: {response.status_code}")
+                return False
             
     except Exception as e:
         print(f"❌ Error testing token: {e}")
         return False
 
-def handle_token_refresh():
+def handle_token_refresh(verify=False):
     """Main function to handle token refresh"""
     print("🔄 WHOOP Token Refresh Handler")
     print("="*50)
@@ -152,10 +160,10 @@ def handle_token_refresh():
     if is_token_expired(credentials):
         print("   ❌ Token is expired or will expire soon")
         
-        # Try to refresh the token
+        # Try to refresh the token; a 200 from the token endpoint already
+        # confirms issuance, so only probe the API when asked to
         if refresh_access_token(credentials):
-            # Test the refreshed token
-            if test_token(credentials):
+            if not verify or test_token(credentials):
                 print("✅ Token refresh successful!")
                 return True
             else:
@@ -169,8 +177,10 @@ def handle_token_refresh():
         return False
         
     else:
-        # Token is still valid, test it anyway
+        # Trust expires_at; callers refresh lazily once the API returns a 401
         print("   ✅ Token is still valid")
+        if not verify:
+            return True
         if test_token(credentials):
             print("✅ Token is working correctly!")
             return True
@@ -235,7 +245,7 @@ def main():
         if command == "status":
             get_token_status()
         elif command == "refresh":
-            handle_token_refresh()
+            handle_token_refresh(verify="--verify" in sys.argv)
         elif command == "test":
             credentials = load_credentials()
             if credentials:
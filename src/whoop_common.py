@@ -0,0 +1,157 @@
+import operator
+import orjson
+import os
+import random
+import requests
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Transient server errors the session adapter retries on its own
+SERVER_ERROR_STATUSES = (500, 502, 503, 504)
+
+# 429 responses a fetcher waits out for one page before giving up on it
+MAX_RATE_LIMIT_RETRIES = 5
+
+# (connect, read) timeout in seconds for requests that don't pass their own, so a
+# stalled connection fails the call instead of hanging a worker forever
+DEFAULT_TIMEOUT = (5, 30)
+
+class TimeoutSession(requests.Session):
+    """Session that applies DEFAULT_TIMEOUT to every request without a timeout"""
+    
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', DEFAULT_TIMEOUT)
+        return super().request(method, url, **kwargs)
+
+def create_session(status_forcelist=SERVER_ERROR_STATUSES, hooks=()):
+    """Create a pooled HTTP session for WHOOP API calls
+    
+    Scripts that handle a status themselves (e.g. 429 with their own backoff)
+    leave it out of status_forcelist so it is not retried twice.
+    """
+    session = TimeoutSession()
+    
+    # Retry transient failures; the final response is still returned so the
+    # caller's status handling keeps working once retries are exhausted
+    retries = Retry(
+        total=3,
+        backoff_factor=1,
+        status_forcelist=list(status_forcelist),
+        respect_retry_after_header=True,
+        raise_on_status=False
+    )
+    adapter = HTTPAdapter(pool_connections=16, pool_maxsize=32, max_retries=retries)
+    session.mount("https://", adapter)
+    
+    for hook in hooks:
+        session.hooks['response'].append(hook)
+    return session
+
+def get_retry_delay(response, attempt):
+    """Seconds to wait after a 429, from Retry-After or exponential backoff"""
+    retry_after = response.headers.get('Retry-After')
+    try:
+        delay = float(retry_after)
+    except (TypeError, ValueError):
+        try:
+            # Retry-After may also be an HTTP date
+            delay = (parsedate_to_datetime(retry_after) - datetime.now(timezone.utc)).total_seconds()
+        except (TypeError, ValueError):
+            delay = min(60, 5 * 2 ** attempt)
+    
+    # Add a little jitter so parallel workers don't retry at the same instant
+    delay = max(0, delay)
+    return delay + random.uniform(0, delay * 0.2 + 1)
+
+def get_expires_at_ts(credentials):
+    """Return a credential's expiry as an epoch timestamp, or None if unknown"""
+    # expires_at wins whenever it parses: a script that refreshed only the ISO
+    # string leaves a stale expires_at_ts behind, and credentials saved before
+    # expires_at_ts existed have nothing else
+    try:
+        return datetime.fromisoformat(credentials['expires_at']).timestamp()
+    except (KeyError, TypeError, ValueError):
+        return credentials.get('expires_at_ts')
+
+def print_error_response(response):
+    """Print a failed response's error details, or a short preview of its body"""
+    try:
+        print(f"Error details: {orjson.loads(response.content)}")
+    except orjson.JSONDecodeError:
+        # Decode only enough bytes for 200 characters (at most 4 bytes each)
+        # rather than the whole error page
+        print(f"Raw response: {response.content[:800].decode('utf-8', errors='replace')[:200]}")
+
+def write_private_file(path, data):
+    """Atomically replace a file with data, readable only by the current user"""
+    temp_file = f"{path}.tmp"
+    # O_CREAT only applies the mode to a new file, so a temp file left behind by
+    # an interrupted save is removed rather than reused with whatever mode it has
+    try:
+        os.remove(temp_file)
+    except FileNotFoundError:
+        pass
+    
+    fd = os.open(temp_file, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    # The file object keeps writing until all of data is out, unlike a single os.write
+    with os.fdopen(fd, "wb") as f:
+        f.write(data)
+    # Swap the file in only once it is complete so an interrupted save leaves the old one intact
+    os.replace(temp_file, path)
+
+# Exported columns of a WHOOP v2 sleep record, in order, with where each value
+# is read from: the record itself, its nested score, or the user it belongs to
+SLEEP_COLUMNS = [
+    ('created_at', 'record', 'created_at'),
+    ('end', 'record', 'end'),
+    ('id', 'record', 'id'),
+    ('nap', 'record', 'nap'),
+    ('score_respiratory_rate', 'score', 'respiratory_rate'),
+    ('score_sleep_consistency_percentage', 'score', 'sleep_consistency_percentage'),
+    ('score_sleep_efficiency_percentage', 'score', 'sleep_efficiency_percentage'),
+    ('score_sleep_needed', 'score', 'sleep_needed'),
+    ('score_sleep_performance_percentage', 'score', 'sleep_performance_percentage'),
+    ('score_stage_summary', 'score', 'stage_summary'),
+    ('score_state', 'record', 'score_state'),
+    ('start', 'record', 'start'),
+    ('timezone_offset', 'record', 'timezone_offset'),
+    ('updated_at', 'record', 'updated_at'),
+    ('user_email', 'user', 'email'),
+    ('user_id', 'record', 'user_id'),
+    ('v1_id', 'record', 'v1_id')
+]
+
+SLEEP_FIELDNAMES = [column for column, _, _ in SLEEP_COLUMNS]
+
+# Turns an email into a filename-safe id in one pass ('@' -> '_at_', '.' -> '_')
+SAFE_EMAIL_TABLE = str.maketrans({'@': '_at_', '.': '_'})
+
+# Keys read from the record itself and from its score, and where each value
+# lands in the exported row; worked out once from SLEEP_COLUMNS so flattening a
+# record is two C-level map passes and one reorder
+SLEEP_RECORD_KEYS = tuple(key for _, source, key in SLEEP_COLUMNS if source == 'record')
+SLEEP_SCORE_KEYS = tuple(key for _, source, key in SLEEP_COLUMNS if source == 'score')
+
+def get_sleep_row_positions():
+    """Map each exported column to its index in record values + score values + [email]"""
+    offsets = {'record': 0, 'score': len(SLEEP_RECORD_KEYS), 'user': len(SLEEP_RECORD_KEYS) + len(SLEEP_SCORE_KEYS)}
+    positions = []
+    for _, source, _ in SLEEP_COLUMNS:
+        positions.append(offsets[source])
+        offsets[source] += 1
+    return positions
+
+SLEEP_ROW_ORDER = operator.itemgetter(*get_sleep_row_positions())
+
+def flatten_sleep_record(record, user_email):
+    """Flatten a sleep record into a CSV row ordered like SLEEP_FIELDNAMES"""
+    score = record.get('score') or {}
+    # Nested score dicts (stage_summary, sleep_needed) are written as compact JSON
+    # so the cells parse downstream; csv.writer would otherwise write their repr
+    score_values = [
+        orjson.dumps(value).decode() if isinstance(value, dict) else value
+        for value in map(score.get, SLEEP_SCORE_KEYS)
+    ]
+    return SLEEP_ROW_ORDER([*map(record.get, SLEEP_RECORD_KEYS), *score_values, user_email])
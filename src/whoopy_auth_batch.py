@@ -1,62 +1,71 @@
 import asyncio
-import json
+import csv
 import os
+import orjson
+import time
 import webbrowser
-import requests
-import pandas as pd
 from urllib.parse import urlencode, parse_qs, urlparse
 from datetime import datetime, timedelta
 from dotenv import load_dotenv
+from whoop_common import create_session, SERVER_ERROR_STATUSES, get_expires_at_ts, print_error_response
 
 load_dotenv()
 
+# Read the app credentials once at import instead of per config lookup
+WHOOP_CLIENT_ID = os.getenv('WHOOP_CLIENT_ID')
+WHOOP_CLIENT_SECRET = os.getenv('WHOOP_CLIENT_SECRET')
+WHOOP_REDIRECT_URI = os.getenv('WHOOP_REDIRECT_URI')
+
+# Token exchanges, refreshes and profile checks for every user in the batch
+# reuse the same keep-alive connections to api.prod.whoop.com
+SESSION = create_session(status_forcelist=(429,) + SERVER_ERROR_STATUSES)
+
 def create_whoop_config():
     """Create WHOOP configuration from environment variables"""
-    client_id = os.getenv('WHOOP_CLIENT_ID')
-    client_secret = os.getenv('WHOOP_CLIENT_SECRET')
-    redirect_uri = os.getenv('WHOOP_REDIRECT_URI')
-    
-    if not all([client_id, client_secret, redirect_uri]):
+    if not all([WHOOP_CLIENT_ID, WHOOP_CLIENT_SECRET, WHOOP_REDIRECT_URI]):
         print("❌ Missing required environment variables:")
-        if not client_id:
+        if not WHOOP_CLIENT_ID:
             print("   - WHOOP_CLIENT_ID")
-        if not client_secret:
+        if not WHOOP_CLIENT_SECRET:
             print("   - WHOOP_CLIENT_SECRET")
-        if not redirect_uri:
+        if not WHOOP_REDIRECT_URI:
             print("   - WHOOP_REDIRECT_URI")
         print("Please check your .env file")
         return None
     
     return {
-        "client_id": client_id,
-        "client_secret": client_secret,
-        "redirect_uri": redirect_uri
+        "client_id": WHOOP_CLIENT_ID,
+        "client_secret": WHOOP_CLIENT_SECRET,
+        "redirect_uri": WHOOP_REDIRECT_URI
     }
 
 def load_users_from_csv(csv_file="users.csv"):
     """Load users from CSV file"""
     try:
-        df = pd.read_csv(csv_file)
-        print(f"✅ Loaded {len(df)} users from {csv_file}")
-        
-        # Check if email column exists
-        if 'email' not in df.columns:
-            print(f"❌ CSV must have 'email' column")
-            print(f"Available columns: {list(df.columns)}")
-            return None
-        
-        # Convert to list of dictionaries
-        users = []
-        for index, row in df.iterrows():
-            user = {
-                'index': index + 1,
-                'email': row['email'],
-                'first_name': row.get('first_name', ''),
-                'last_name': row.get('last_name', ''),
-                'password': row.get('password', 'Not provided')
-            }
-            users.append(user)
+        # utf-8-sig drops the byte order mark spreadsheet apps often add
+        with open(csv_file, newline='', encoding='utf-8-sig') as f:
+            reader = csv.DictReader(f, restval='')
+            fieldnames = reader.fieldnames or []
+            
+            # Check if email column exists
+            if 'email' not in fieldnames:
+                print(f"❌ CSV must have 'email' column")
+                print(f"Available columns: {fieldnames}")
+                return None
+            
+            # Convert to list of dictionaries
+            users = [
+                {
+                    'index': index,
+                    'email': row['email'],
+                    'first_name': row.get('first_name', ''),
+                    'last_name': row.get('last_name', ''),
+                    'password': row.get('password', 'Not provided')
+                }
+                for index, row in enumerate(reader, 1)
+            ]
         
+        print(f"✅ Loaded {len(users)} users from {csv_file}")
         return users
         
     except FileNotFoundError:
@@ -67,17 +76,33 @@ def load_users_from_csv(csv_file="users.csv"):
         print(f"❌ Error reading CSV file: {e}")
         return None
 
+def read_file_bytes(path):
+    """Return a file's contents, or None if it does not exist"""
+    try:
+        with open(path, "rb") as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
 def save_batch_credentials(all_credentials):
     """Save batch credentials to .whoop_credentials_batch.json"""
-    with open(".whoop_credentials_batch.json", "w") as f:
-        json.dump(all_credentials, f, indent=2)
+    data = orjson.dumps(all_credentials, option=orjson.OPT_INDENT_2)
+    if read_file_bytes(".whoop_credentials_batch.json") == data:
+        print("✅ Batch credentials unchanged, .whoop_credentials_batch.json not rewritten")
+        return
+    
+    temp_file = ".whoop_credentials_batch.json.tmp"
+    with open(temp_file, "wb") as f:
+        f.write(data)
+    # Swap the file in only once it is complete so an interrupted save leaves the old credentials intact
+    os.replace(temp_file, ".whoop_credentials_batch.json")
     print("✅ Batch credentials saved to .whoop_credentials_batch.json")
 
 def load_batch_credentials():
     """Load existing batch credentials"""
     try:
-        with open(".whoop_credentials_batch.json", "r") as f:
-            return json.load(f)
+        with open(".whoop_credentials_batch.json", "rb") as f:
+            return orjson.loads(f.read())
     except FileNotFoundError:
         return {}
     except Exception as e:
@@ -151,7 +176,7 @@ async def authenticate_single_user(user, config, scopes):
     }
     
     try:
-        response = requests.post(token_url, data=token_data)
+        response = SESSION.post(token_url, data=token_data)
         
         if response.status_code == 200:
             token_response = response.json()
@@ -180,6 +205,7 @@ async def authenticate_single_user(user, config, scopes):
                 "refresh_token": refresh_token,
                 "expires_in": expires_in,
                 "expires_at": expires_at.isoformat(),
+                "expires_at_ts": expires_at.timestamp(),
                 "token_type": token_response.get('token_type', 'bearer'),
                 "scope": token_response.get('scope', scopes),
                 "auth_timestamp": datetime.now().isoformat(),
@@ -197,11 +223,7 @@ async def authenticate_single_user(user, config, scopes):
             
         else:
             print(f"❌ Token exchange failed for {user['email']}: {response.status_code}")
-            try:
-                error_data = response.json()
-                print(f"Error details: {error_data}")
-            except:
-                print(f"Raw response: {response.text[:200]}")
+            print_error_response(response)
             return None
             
     except Exception as e:
@@ -210,37 +232,50 @@ async def authenticate_single_user(user, config, scopes):
 
 async def get_user_profile(access_token):
     """Get user profile information"""
-    headers = {
-        "Authorization": f"Bearer {access_token}",
-        "Content-Type": "application/json"
-    }
+    # GETs carry no body, so only the Authorization header is needed
+    headers = {"Authorization": f"Bearer {access_token}"}
     
     try:
-        response = requests.get("https://api.prod.whoop.com/developer/v2/user/profile/basic", headers=headers)
-        
-        if response.status_code == 200:
-            return response.json()
-        else:
-            return None
+        # Stream so a failed lookup is closed without downloading its error body
+        with SESSION.get("https://api.prod.whoop.com/developer/v2/user/profile/basic", headers=headers, stream=True) as response:
+            if response.status_code == 200:
+                return orjson.loads(response.content)
+            else:
+                return None
             
     except Exception as e:
         return None
 
-async def refresh_user_token(user_email, refresh_token, config):
-    """Refresh access token for a specific user (following WHOOP docs)"""
-    print(f"🔄 Refreshing access token for {user_email}...")
-    
-    token_url = "https://api.prod.whoop.com/oauth/oauth2/token"
-    token_data = {
+def build_refresh_body_prefix(config):
+    """Form-encode the refresh request fields that are the same for every user"""
+    return urlencode({
         "grant_type": "refresh_token",
-        "refresh_token": refresh_token,
         "client_id": config["client_id"],
         "client_secret": config["client_secret"],
         "scope": "offline"  # Include offline scope in refresh request
-    }
+    }).encode()
+
+async def refresh_user_token(user_email, refresh_token, config, all_credentials=None, body_prefix=None):
+    """Refresh access token for a specific user (following WHOOP docs)"""
+    # With all_credentials given, only that dict is updated and the caller saves
+    # it once; otherwise the credentials file is loaded and saved for this user
+    print(f"🔄 Refreshing access token for {user_email}...")
+    
+    token_url = "https://api.prod.whoop.com/oauth/oauth2/token"
+    # Batch callers encode the shared fields once and only the refresh token
+    # is appended per user
+    if body_prefix is None:
+        body_prefix = build_refresh_body_prefix(config)
+    token_data = body_prefix + b"&" + urlencode({"refresh_token": refresh_token}).encode()
     
     try:
-        response = requests.post(token_url, data=token_data)
+        # Run the blocking POST in a worker thread so several refreshes can be
+        # in flight at once; credentials are still updated on the event loop,
+        # one refresh at a time
+        response = await asyncio.to_thread(
+            SESSION.post, token_url, data=token_data,
+            headers={"Content-Type": "application/x-www-form-urlencoded"}
+        )
         
         if response.status_code == 200:
             token_response = response.json()
@@ -250,7 +285,9 @@ async def refresh_user_token(user_email, refresh_token, config):
             expires_at = datetime.now() + timedelta(seconds=expires_in)
             
             # Load existing batch credentials
-            all_credentials = load_batch_credentials()
+            save_after_update = all_credentials is None
+            if save_after_update:
+                all_credentials = load_batch_credentials()
             
             # Update the specific user's credentials
             if user_email in all_credentials:
@@ -259,13 +296,15 @@ async def refresh_user_token(user_email, refresh_token, config):
                     "refresh_token": token_response.get('refresh_token', refresh_token),  # Use new refresh token if provided
                     "expires_in": expires_in,
                     "expires_at": expires_at.isoformat(),
+                    "expires_at_ts": expires_at.timestamp(),
                     "token_type": token_response.get('token_type', 'bearer'),
                     "scope": token_response.get('scope', 'offline'),
                     "auth_timestamp": datetime.now().isoformat()
                 })
                 
                 # Save updated credentials
-                save_batch_credentials(all_credentials)
+                if save_after_update:
+                    await asyncio.to_thread(save_batch_credentials, all_credentials)
                 
                 print(f"✅ Token refresh successful for {user_email}!")
                 print(f"📅 New token expires at: {expires_at}")
@@ -276,11 +315,7 @@ async def refresh_user_token(user_email, refresh_token, config):
             
         else:
             print(f"❌ Token refresh failed for {user_email}: {response.status_code}")
-            try:
-                error_data = response.json()
-                print(f"Error details: {error_data}")
-            except:
-                print(f"Raw response: {response.text[:200]}")
+            print_error_response(response)
             return False
             
     except Exception as e:
@@ -295,19 +330,29 @@ async def test_batch_credentials(all_credentials):
     successful_tests = 0
     failed_tests = 0
     
-    for email, credentials in all_credentials.items():
+    # Test user profile endpoint
+    profile_url = "https://api.prod.whoop.com/developer/v2/user/profile/basic"
+    
+    # The probes are independent, so send them all at once from worker threads
+    # over the shared session and report the results in the original order
+    responses = await asyncio.gather(
+        *(
+            asyncio.to_thread(
+                SESSION.get, profile_url,
+                headers={"Authorization": f"Bearer {credentials['access_token']}"}
+            )
+            for credentials in all_credentials.values()
+        ),
+        return_exceptions=True
+    )
+    
+    for email, response in zip(all_credentials, responses):
         print(f"\n👤 Testing {email}...")
         
-        headers = {
-            "Authorization": f"Bearer {credentials['access_token']}",
-            "Content-Type": "application/json"
-        }
-        
-        # Test user profile endpoint
-        profile_url = "https://api.prod.whoop.com/developer/v2/user/profile/basic"
-        response = requests.get(profile_url, headers=headers)
-        
-        if response.status_code == 200:
+        if isinstance(response, Exception):
+            print(f"❌ {email}: API test failed - {response}")
+            failed_tests += 1
+        elif response.status_code == 200:
             profile_data = response.json()
             print(f"✅ {email}: API test successful!")
             print(f"   👤 WHOOP Name: {profile_data.get('first_name', 'Unknown')} {profile_data.get('last_name', 'Unknown')}")
@@ -323,6 +368,54 @@ async def test_batch_credentials(all_credentials):
     
     return successful_tests > 0
 
+async def refresh_expiring_tokens(config):
+    """Refresh every batch token that expires within the next 5 minutes"""
+    print("\n🔄 Checking batch tokens for upcoming expiry...")
+    print("="*60)
+    
+    all_credentials = load_batch_credentials()
+    if not all_credentials:
+        print("❌ No batch credentials found")
+        return False
+    
+    # Refresh ahead of the fetch runs so they find fresh tokens instead of
+    # paying for a refresh on their critical path
+    refresh_before = time.time() + 300
+    expiring = []
+    for email, credentials in all_credentials.items():
+        # An unknown expiry counts as expiring; refreshing is the safe choice
+        expires_at_ts = get_expires_at_ts(credentials)
+        if expires_at_ts is not None and expires_at_ts > refresh_before:
+            continue
+        if not credentials.get('refresh_token'):
+            print(f"⏭️  {email}: no refresh token, re-authenticate this user")
+            continue
+        expiring.append(email)
+    
+    if not expiring:
+        print("✅ No tokens need refreshing")
+        return True
+    
+    print(f"📋 {len(expiring)} token(s) expire within 5 minutes")
+    
+    # Refresh all expiring users concurrently rather than one round trip at a
+    # time; they all update the same dict, which is written to disk once
+    body_prefix = build_refresh_body_prefix(config)
+    results = await asyncio.gather(
+        *(
+            refresh_user_token(email, all_credentials[email]['refresh_token'], config, all_credentials, body_prefix)
+            for email in expiring
+        ),
+        return_exceptions=True
+    )
+    refreshed = sum(result is True for result in results)
+    if refreshed:
+        # Serialize and write off the event loop
+        await asyncio.to_thread(save_batch_credentials, all_credentials)
+    
+    print(f"\n📊 Refreshed {refreshed}/{len(expiring)} tokens")
+    return refreshed == len(expiring)
+
 async def batch_authentication():
     """Main batch authentication function following official WHOOP OAuth 2.0"""
     print("🚀 WHOOP Batch Authentication (Official OAuth 2.0)")
@@ -427,7 +520,7 @@ async def batch_authentication():
     
     # Save all credentials
     if newly_authenticated > 0:
-        save_batch_credentials(all_credentials)
+        await asyncio.to_thread(save_batch_credentials, all_credentials)
         print(f"\n✅ Successfully authenticated {newly_authenticated} new users")
         print(f"📊 Total authenticated users: {len(all_credentials)}")
         
@@ -450,28 +543,31 @@ def list_batch_users():
     print(f"\n👥 Batch Authenticated Users ({len(credentials)}):")
     print("="*80)
     
+    # Collect every user's lines and print them in one write
+    now = time.time()
+    lines = []
     for email, user_data in credentials.items():
-        print(f"📧 {email}")
-        print(f"   👤 Name: {user_data.get('first_name', '')} {user_data.get('last_name', '')}")
-        print(f"   🆔 WHOOP ID: {user_data.get('whoop_user_id', 'Not available')}")
-        print(f"   📅 Authenticated: {user_data.get('auth_timestamp', 'Unknown')}")
+        lines.append(f"📧 {email}")
+        lines.append(f"   👤 Name: {user_data.get('first_name', '')} {user_data.get('last_name', '')}")
+        lines.append(f"   🆔 WHOOP ID: {user_data.get('whoop_user_id', 'Not available')}")
+        lines.append(f"   📅 Authenticated: {user_data.get('auth_timestamp', 'Unknown')}")
         
         # Check if token is expired
-        if 'expires_at' in user_data:
-            try:
-                expires_at = datetime.fromisoformat(user_data['expires_at'])
-                if datetime.now() > expires_at:
-                    print(f"   ⚠️  Token: EXPIRED")
-                else:
-                    time_left = expires_at - datetime.now()
-                    print(f"   ✅ Token: Valid ({time_left})")
-            except:
-                print(f"   ⚠️  Token: Unknown status")
+        if 'expires_at' in user_data or 'expires_at_ts' in user_data:
+            expires_at_ts = get_expires_at_ts(user_data)
+            if expires_at_ts is None:
+                lines.append(f"   ⚠️  Token: Unknown status")
+            elif now > expires_at_ts:
+                lines.append(f"   ⚠️  Token: EXPIRED")
+            else:
+                time_left = timedelta(seconds=int(expires_at_ts - now))
+                lines.append(f"   ✅ Token: Valid ({time_left})")
         
         # Check refresh token
         has_refresh = user_data.get('refresh_token') is not None
-        print(f"   🔄 Refresh Token: {'✅ Available' if has_refresh else '❌ Not Available'}")
-        print()
+        lines.append(f"   🔄 Refresh Token: {'✅ Available' if has_refresh else '❌ Not Available'}")
+        lines.append("")
+    print("\n".join(lines))
 
 def main():
     """Main function"""
@@ -483,9 +579,10 @@ def main():
         print("1. Start batch authentication")
         print("2. List authenticated users")
         print("3. Test batch credentials")
-        print("4. Exit")
+        print("4. Refresh expiring tokens")
+        print("5. Exit")
         
-        choice = input("\nSelect option (1-4): ").strip()
+        choice = input("\nSelect option (1-5): ").strip()
         
         if choice == '1':
             success = asyncio.run(batch_authentication())
@@ -504,6 +601,11 @@ def main():
                 print("❌ No batch credentials found")
         
         elif choice == '4':
+            config = create_whoop_config()
+            if config:
+                asyncio.run(refresh_expiring_tokens(config))
+        
+        elif choice == '5':
             print("👋 Goodbye!")
             break
         
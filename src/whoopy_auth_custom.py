@@ -1,49 +1,166 @@
 import asyncio
-import json
 import os
+import orjson
+import secrets
+import shutil
+import subprocess
+import sys
+import time
 import webbrowser
-import requests
+from http.server import BaseHTTPRequestHandler, HTTPServer
 from urllib.parse import urlencode, parse_qs, urlparse
 from datetime import datetime, timedelta
 from dotenv import load_dotenv
+from whoop_common import (
+    create_session, SERVER_ERROR_STATUSES, get_expires_at_ts, print_error_response, write_private_file
+)
 
 load_dotenv()
 
+# Read the app credentials once at import instead of per config lookup
+WHOOP_CLIENT_ID = os.getenv('WHOOP_CLIENT_ID')
+WHOOP_CLIENT_SECRET = os.getenv('WHOOP_CLIENT_SECRET')
+WHOOP_REDIRECT_URI = os.getenv('WHOOP_REDIRECT_URI')
+
+# The token exchange and the follow-up API tests reuse the same keep-alive
+# connections to api.prod.whoop.com
+SESSION = create_session(status_forcelist=(429,) + SERVER_ERROR_STATUSES)
+
+# Define scopes according to WHOOP documentation
+# The 'offline' scope is REQUIRED to receive refresh tokens
+WHOOP_SCOPES = ("read:recovery", "read:sleep", "read:workout", "read:profile", "offline")
+WHOOP_SCOPE_STRING = " ".join(WHOOP_SCOPES)
+SCOPE_BANNER = "\n".join(
+    ["📋 Requesting scopes (following WHOOP OAuth documentation):"]
+    + [f"   - {scope} (REQUIRED for refresh tokens)" if scope == "offline" else f"   - {scope}" for scope in WHOOP_SCOPES]
+    + [""]
+)
+
+# Native URL opener, looked up once; webbrowser probes its list of browsers
+# on first use, so it is only the fallback
+if sys.platform == "darwin":
+    BROWSER_COMMAND = shutil.which("open")
+else:
+    BROWSER_COMMAND = shutil.which("xdg-open")
+
+# How long to wait for WHOOP to redirect back to a local redirect URI
+REDIRECT_WAIT_SECONDS = 5 * 60
+
+# Last parsed .whoop_credentials.json, reused until the file's mtime or size changes
+CREDENTIALS_FILE_CACHE = {"mtime_ns": None, "size": None, "data": None}
+
+# Tokens within this many seconds of expiry are refreshed in the background
+# while the current one is still handed out
+TOKEN_REFRESH_BUFFER_SECONDS = 5 * 60
+
+# get_access_token()'s refresh lock and background task; asyncio objects belong
+# to one event loop, so both are recreated when a new loop (e.g. another
+# asyncio.run) first asks for them
+REFRESH_STATE = {"loop": None, "lock": None, "task": None}
+
 def create_whoop_config():
     """Create WHOOP configuration from environment variables"""
-    client_id = os.getenv('WHOOP_CLIENT_ID')
-    client_secret = os.getenv('WHOOP_CLIENT_SECRET')
-    redirect_uri = os.getenv('WHOOP_REDIRECT_URI')
-    
-    if not all([client_id, client_secret, redirect_uri]):
+    if not all([WHOOP_CLIENT_ID, WHOOP_CLIENT_SECRET, WHOOP_REDIRECT_URI]):
         print("❌ Missing required environment variables:")
-        if not client_id:
+        if not WHOOP_CLIENT_ID:
             print("   - WHOOP_CLIENT_ID")
-        if not client_secret:
+        if not WHOOP_CLIENT_SECRET:
             print("   - WHOOP_CLIENT_SECRET")
-        if not redirect_uri:
+        if not WHOOP_REDIRECT_URI:
             print("   - WHOOP_REDIRECT_URI")
         print("Please check your .env file")
         return None
     
     return {
-        "client_id": client_id,
-        "client_secret": client_secret,
-        "redirect_uri": redirect_uri
+        "client_id": WHOOP_CLIENT_ID,
+        "client_secret": WHOOP_CLIENT_SECRET,
+        "redirect_uri": WHOOP_REDIRECT_URI
     }
 
 def save_config_to_file(config):
     """Save configuration to config.json for whoopy"""
-    with open("config.json", "w") as f:
-        json.dump(config, f, indent=2)
+    write_private_file("config.json", orjson.dumps(config, option=orjson.OPT_INDENT_2))
     print("✅ Configuration saved to config.json")
 
 def save_credentials(credentials):
     """Save credentials to .whoop_credentials.json"""
-    with open(".whoop_credentials.json", "w") as f:
-        json.dump(credentials, f, indent=2)
+    write_private_file(".whoop_credentials.json", orjson.dumps(credentials, option=orjson.OPT_INDENT_2))
     print("✅ Credentials saved to .whoop_credentials.json")
 
+def build_auth_url_prefix(config, scope_string):
+    """Encode the authorization URL up to its state value"""
+    auth_url = "https://api.prod.whoop.com/oauth/oauth2/auth"
+    auth_params = {
+        "response_type": "code",
+        "client_id": config["client_id"],
+        "redirect_uri": config["redirect_uri"],
+        "scope": scope_string
+    }
+    return f"{auth_url}?{urlencode(auth_params)}&state="
+
+def open_browser(url):
+    """Open a URL in the default browser"""
+    if BROWSER_COMMAND:
+        try:
+            subprocess.Popen([BROWSER_COMMAND, url], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            return True
+        except OSError:
+            pass
+    return webbrowser.open(url)
+
+class RedirectHandler(BaseHTTPRequestHandler):
+    """Capture the query string WHOOP sends to the local redirect URI"""
+    
+    def do_GET(self):
+        request = urlparse(self.path)
+        if request.path != self.server.redirect_path:
+            # Browsers also ask for things like /favicon.ico
+            self.send_error(404)
+            return
+        
+        # Anything not carrying the state sent with this run's authorization
+        # URL is refused, and the server keeps waiting for the real redirect
+        if parse_qs(request.query).get("state", [None])[0] != self.server.expected_state:
+            self.send_error(400, "State does not match this authorization request")
+            return
+        
+        self.server.redirect_query = request.query
+        body = "WHOOP authorization received. You can close this window.".encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def log_message(self, format, *args):
+        # Keep the console to the auth flow's own messages
+        pass
+
+def is_local_redirect_uri(redirect_uri):
+    """Check whether the redirect URI points at a plain-HTTP listener on this machine"""
+    parsed = urlparse(redirect_uri)
+    return parsed.scheme == "http" and parsed.hostname in ("localhost", "127.0.0.1")
+
+def create_redirect_server(redirect_uri, expected_state):
+    """Bind an HTTP server on the local redirect URI before the browser is sent there"""
+    parsed = urlparse(redirect_uri)
+    server = HTTPServer((parsed.hostname, parsed.port or 80), RedirectHandler)
+    server.redirect_path = parsed.path or "/"
+    server.expected_state = expected_state
+    server.redirect_query = None
+    return server
+
+def wait_for_redirect(server, timeout=REDIRECT_WAIT_SECONDS):
+    """Serve requests until the redirect arrives, returning its query string or None"""
+    deadline = time.time() + timeout
+    try:
+        while server.redirect_query is None and time.time() < deadline:
+            server.timeout = deadline - time.time()
+            server.handle_request()
+    finally:
+        server.server_close()
+    return server.redirect_query
+
 async def custom_whoop_auth():
     """Custom WHOOP authentication following official OAuth 2.0 flow"""
     print("🔐 Custom WHOOP Authentication (Official OAuth 2.0)")
@@ -57,48 +174,58 @@ async def custom_whoop_auth():
     # Save config for whoopy
     save_config_to_file(config)
     
-    # Define scopes according to WHOOP documentation
-    # The 'offline' scope is REQUIRED to receive refresh tokens
-    scopes = ["read:recovery", "read:sleep", "read:workout", "read:profile", "offline"]
-    scope_string = " ".join(scopes)
+    print(SCOPE_BANNER)
     
-    print("📋 Requesting scopes (following WHOOP OAuth documentation):")
-    for scope in scopes:
-        if scope == "offline":
-            print(f"   - {scope} (REQUIRED for refresh tokens)")
-        else:
-            print(f"   - {scope}")
-    print()
+    # Step 1: Create authorization URL (following WHOOP docs); only the state
+    # is appended per run, and it is random so a redirect can be tied to this run
+    state = "custom_auth_flow_" + secrets.token_urlsafe(16)
+    auth_url_with_params = build_auth_url_prefix(config, WHOOP_SCOPE_STRING) + state
     
-    # Step 1: Create authorization URL (following WHOOP docs)
-    auth_url = "https://api.prod.whoop.com/oauth/oauth2/auth"
-    auth_params = {
-        "response_type": "code",
-        "client_id": config["client_id"],
-        "redirect_uri": config["redirect_uri"],
-        "scope": scope_string,
-        "state": "custom_auth_flow_" + str(int(datetime.now().timestamp()))
-    }
-    
-    auth_url_with_params = f"{auth_url}?{urlencode(auth_params)}"
+    # Catch the redirect ourselves when the redirect URI points at this
+    # machine; otherwise the user pastes it back in
+    redirect_server = None
+    if is_local_redirect_uri(config["redirect_uri"]):
+        try:
+            redirect_server = create_redirect_server(config["redirect_uri"], state)
+        except OSError as e:
+            print(f"⚠️  Could not listen on {config['redirect_uri']}: {e}")
     
-    print("🔐 Opening browser for authorization...")
-    print(f"📋 Authorization URL: {auth_url_with_params}")
-    print()
-    print("📝 After authorization, you'll be redirected to your redirect URI")
-    print("📝 Copy the entire URL from your browser and paste it below")
-    print()
+    lines = [
+        "🔐 Opening browser for authorization...",
+        f"📋 Authorization URL: {auth_url_with_params}",
+        "",
+        "📝 After authorization, you'll be redirected to your redirect URI"
+    ]
+    if not redirect_server:
+        lines.append("📝 Copy the entire URL from your browser and paste it below")
+    lines.append("")
+    print("\n".join(lines))
     
     # Open browser
-    webbrowser.open(auth_url_with_params)
+    open_browser(auth_url_with_params)
     
-    # Step 2: Get authorization code from user
-    print("📋 Paste the redirect URL here:")
-    redirect_url = input().strip()
+    # Step 2: Get authorization code from the redirect
+    redirect_query = None
+    if redirect_server:
+        print(f"⏳ Waiting for the redirect to {config['redirect_uri']}...")
+        redirect_query = await asyncio.to_thread(wait_for_redirect, redirect_server)
+        if redirect_query is None:
+            # The browser may be on another machine (e.g. over SSH), where the
+            # redirect never reaches this listener; its URL can still be pasted
+            print("⚠️  Timed out waiting for the authorization redirect")
+            print("📝 Copy the entire URL from your browser and paste it below")
     
-    # Parse the redirect URL to get the authorization code
-    parsed_url = urlparse(redirect_url)
-    query_params = parse_qs(parsed_url.query)
+    if redirect_query is None:
+        print("📋 Paste the redirect URL here:")
+        redirect_query = urlparse(input().strip()).query
+    
+    # Parse the redirect query to get the authorization code
+    query_params = parse_qs(redirect_query)
+    
+    # Only accept a redirect answering the authorization request made above
+    if query_params.get('state', [None])[0] != state:
+        print("❌ Redirect URL does not match this authorization request (state mismatch)")
+        return False
     
     # Check for errors
     if 'error' in query_params:
@@ -132,14 +259,17 @@ async def custom_whoop_auth():
     }
     
     try:
-        response = requests.post(token_url, data=token_data)
+        # Run the blocking POST in a worker thread so the event loop stays free
+        response = await asyncio.to_thread(SESSION.post, token_url, data=token_data)
         
         if response.status_code == 200:
-            token_response = response.json()
+            token_response = orjson.loads(response.content)
             
             # Calculate expiration time
             expires_in = token_response.get('expires_in', 3600)
-            expires_at = datetime.now() + timedelta(seconds=expires_in)
+            # Take one timestamp for both the expiry and auth_timestamp
+            now = datetime.now()
+            expires_at = now + timedelta(seconds=expires_in)
             
             # Check if we got a refresh token
             refresh_token = token_response.get('refresh_token')
@@ -155,9 +285,10 @@ async def custom_whoop_auth():
                 "refresh_token": refresh_token,
                 "expires_in": expires_in,
                 "expires_at": expires_at.isoformat(),
+                "expires_at_ts": expires_at.timestamp(),
                 "token_type": token_response.get('token_type', 'bearer'),
-                "scope": token_response.get('scope', scope_string),
-                "auth_timestamp": datetime.now().isoformat()
+                "scope": token_response.get('scope', WHOOP_SCOPE_STRING),
+                "auth_timestamp": now.isoformat()
             }
             
             # Save credentials
@@ -176,39 +307,46 @@ async def custom_whoop_auth():
             
         else:
             print(f"❌ Token exchange failed: {response.status_code}")
-            try:
-                error_data = response.json()
-                print(f"Error details: {error_data}")
-            except:
-                print(f"Raw response: {response.text[:200]}")
+            print_error_response(response)
             return False
             
     except Exception as e:
         print(f"❌ Exception during token exchange: {e}")
         return False
 
-async def refresh_access_token(refresh_token, config):
-    """Refresh access token using refresh token (following WHOOP docs)"""
-    print("🔄 Refreshing access token...")
-    
-    token_url = "https://api.prod.whoop.com/oauth/oauth2/token"
-    token_data = {
+def build_refresh_body_prefix(config):
+    """Form-encode the refresh request fields that do not change between refreshes"""
+    return urlencode({
         "grant_type": "refresh_token",
-        "refresh_token": refresh_token,
         "client_id": config["client_id"],
         "client_secret": config["client_secret"],
         "scope": "offline"  # Include offline scope in refresh request
-    }
+    }).encode()
+
+async def refresh_access_token(refresh_token, config, body_prefix=None):
+    """Refresh access token using refresh token (following WHOOP docs)"""
+    print("🔄 Refreshing access token...")
+    
+    token_url = "https://api.prod.whoop.com/oauth/oauth2/token"
+    # Callers that refresh repeatedly can pass a prefix encoded once; only the
+    # refresh token is appended per call
+    if body_prefix is None:
+        body_prefix = build_refresh_body_prefix(config)
+    token_data = body_prefix + b"&" + urlencode({"refresh_token": refresh_token}).encode()
     
     try:
-        response = requests.post(token_url, data=token_data)
+        response = await asyncio.to_thread(
+            SESSION.post, token_url, data=token_data,
+            headers={"Content-Type": "application/x-www-form-urlencoded"}
+        )
         
         if response.status_code == 200:
-            token_response = response.json()
+            token_response = orjson.loads(response.content)
             
             # Calculate new expiration time
             expires_in = token_response.get('expires_in', 3600)
-            expires_at = datetime.now() + timedelta(seconds=expires_in)
+            now = datetime.now()
+            expires_at = now + timedelta(seconds=expires_in)
             
             # Create updated credentials
             credentials = {
@@ -216,9 +354,10 @@ async def refresh_access_token(refresh_token, config):
                 "refresh_token": token_response.get('refresh_token', refresh_token),  # Use new refresh token if provided
                 "expires_in": expires_in,
                 "expires_at": expires_at.isoformat(),
+                "expires_at_ts": expires_at.timestamp(),
                 "token_type": token_response.get('token_type', 'bearer'),
                 "scope": token_response.get('scope', 'offline'),
-                "auth_timestamp": datetime.now().isoformat()
+                "auth_timestamp": now.isoformat()
             }
             
             # Save updated credentials
@@ -230,70 +369,157 @@ async def refresh_access_token(refresh_token, config):
             
         else:
             print(f"❌ Token refresh failed: {response.status_code}")
-            try:
-                error_data = response.json()
-                print(f"Error details: {error_data}")
-            except:
-                print(f"Raw response: {response.text[:200]}")
+            print_error_response(response)
             return False
             
     except Exception as e:
         print(f"❌ Exception during token refresh: {e}")
         return False
 
+def load_credentials():
+    """Load credentials from .whoop_credentials.json, or None if there are none"""
+    try:
+        stat = os.stat(".whoop_credentials.json")
+    except FileNotFoundError:
+        return None
+    
+    if (CREDENTIALS_FILE_CACHE["mtime_ns"] == stat.st_mtime_ns
+            and CREDENTIALS_FILE_CACHE["size"] == stat.st_size):
+        return CREDENTIALS_FILE_CACHE["data"]
+    
+    with open(".whoop_credentials.json", "rb") as f:
+        # Key the cache on the file actually read; a save may have replaced
+        # it since the stat above
+        stat = os.fstat(f.fileno())
+        credentials = orjson.loads(f.read())
+    
+    # Parse the expiry once per read so token checks only compare numbers;
+    # an unknown expiry counts as expired
+    credentials['expires_at_ts'] = get_expires_at_ts(credentials) or 0
+    
+    CREDENTIALS_FILE_CACHE.update(mtime_ns=stat.st_mtime_ns, size=stat.st_size, data=credentials)
+    return credentials
+
+def get_refresh_state():
+    """Return REFRESH_STATE for the running event loop, resetting it for a new loop"""
+    loop = asyncio.get_running_loop()
+    if REFRESH_STATE["loop"] is not loop:
+        REFRESH_STATE.update(loop=loop, lock=asyncio.Lock(), task=None)
+    return REFRESH_STATE
+
+async def refresh_cached_token(config):
+    """Refresh the saved token unless another caller already did"""
+    async with get_refresh_state()["lock"]:
+        # A caller that waited on the lock finds the refreshed credentials here
+        credentials = load_credentials()
+        if credentials is None:
+            return False
+        if credentials['expires_at_ts'] - time.time() > TOKEN_REFRESH_BUFFER_SECONDS:
+            return True
+        return await refresh_access_token(credentials['refresh_token'], config)
+
+async def get_access_token(config=None):
+    """Return a usable access token, refreshing it ahead of expiry"""
+    credentials = load_credentials()
+    if credentials is None:
+        print("❌ No credentials found. Run: python src/whoopy_auth_custom.py")
+        return None
+    
+    # Fresh: hand out the saved token
+    seconds_left = credentials['expires_at_ts'] - time.time()
+    if seconds_left > TOKEN_REFRESH_BUFFER_SECONDS:
+        return credentials['access_token']
+    
+    if not credentials.get('refresh_token'):
+        print("⚠️  No refresh token available; re-authenticate when the token expires")
+        return credentials['access_token'] if seconds_left > 0 else None
+    
+    config = config or create_whoop_config()
+    if not config:
+        return credentials['access_token'] if seconds_left > 0 else None
+    
+    # Stale: the token still works, so refresh in the background and return it
+    if seconds_left > 0:
+        state = get_refresh_state()
+        if state["task"] is None or state["task"].done():
+            state["task"] = asyncio.create_task(refresh_cached_token(config))
+        return credentials['access_token']
+    
+    # Expired: the caller has to wait for the refresh
+    if await refresh_cached_token(config):
+        return load_credentials()['access_token']
+    return None
+
+async def wait_for_token_refresh():
+    """Wait for a background refresh started on this loop to finish"""
+    # asyncio.run cancels tasks still pending when it returns, which could drop
+    # a rotated refresh token before it is saved
+    task = get_refresh_state()["task"]
+    if task is not None and not task.done():
+        await task
+
 async def test_credentials():
     """Test the saved credentials"""
     print("\n🧪 Testing saved credentials...")
     
     try:
-        # Load credentials
-        with open(".whoop_credentials.json", "r") as f:
-            credentials = json.load(f)
+        # Load credentials, refreshing the token if it is close to expiry
+        access_token = await get_access_token()
+        if access_token is None:
+            return False
         
         # Test API call directly (without whoopy client)
         headers = {
-            "Authorization": f"Bearer {credentials['access_token']}",
+            "Authorization": f"Bearer {access_token}",
             "Content-Type": "application/json"
         }
         
-        # Test user profile endpoint
+        # Test the user profile and sleep endpoints; the two GETs are
+        # independent, so they run concurrently
         profile_url = "https://api.prod.whoop.com/developer/v2/user/profile/basic"
-        response = requests.get(profile_url, headers=headers)
+        sleep_url = "https://api.prod.whoop.com/developer/v2/activity/sleep"
+        sleep_params = {
+            'start': '2024-08-01T00:00:00.000Z',
+            'end': '2024-08-02T00:00:00.000Z',
+            'limit': 1
+        }
+        response, sleep_response = await asyncio.gather(
+            asyncio.to_thread(SESSION.get, profile_url, headers=headers),
+            asyncio.to_thread(SESSION.get, sleep_url, headers=headers, params=sleep_params)
+        )
         
         if response.status_code == 200:
-            profile_data = response.json()
-            print(f"✅ API test successful!")
-            print(f"👤 User: {profile_data.get('first_name', 'Unknown')} {profile_data.get('last_name', 'Unknown')}")
-            print(f"🆔 WHOOP User ID: {profile_data.get('user_id', 'Unknown')}")
-            
-            # Also test sleep endpoint
-            sleep_url = "https://api.prod.whoop.com/developer/v2/activity/sleep"
-            sleep_params = {
-                'start': '2024-08-01T00:00:00.000Z',
-                'end': '2024-08-02T00:00:00.000Z',
-                'limit': 1
-            }
-            sleep_response = requests.get(sleep_url, headers=headers, params=sleep_params)
+            profile_data = orjson.loads(response.content)
+            lines = [
+                f"✅ API test successful!",
+                f"👤 User: {profile_data.get('first_name', 'Unknown')} {profile_data.get('last_name', 'Unknown')}",
+                f"🆔 WHOOP User ID: {profile_data.get('user_id', 'Unknown')}"
+            ]
             
             if sleep_response.status_code == 200:
-                sleep_data = sleep_response.json()
-                print(f"😴 Sleep API test successful! Records available: {len(sleep_data.get('records', []))}")
+                sleep_data = orjson.loads(sleep_response.content)
+                lines.append(f"😴 Sleep API test successful! Records available: {len(sleep_data.get('records', []))}")
             else:
-                print(f"⚠️  Sleep API test failed: {sleep_response.status_code}")
+                lines.append(f"⚠️  Sleep API test failed: {sleep_response.status_code}")
+            print("\n".join(lines))
             
             return True
         else:
             print(f"❌ API test failed: {response.status_code}")
-            try:
-                error_data = response.json()
-                print(f"Error details: {error_data}")
-            except:
-                print(f"Raw response: {response.text[:200]}")
+            print_error_response(response)
             return False
             
     except Exception as e:
         print(f"❌ Error testing credentials: {e}")
         return False
+    finally:
+        await wait_for_token_refresh()
+
+async def authenticate_and_test():
+    """Run the auth flow and, if it succeeds, test the new credentials"""
+    if not await custom_whoop_auth():
+        return False, False
+    return True, await test_credentials()
 
 def main():
     """Main function"""
@@ -312,13 +538,10 @@ def main():
             print("💡 Run: python src/custom_sleep_fetcher.py")
             return
     
-    # Run authentication
-    success = asyncio.run(custom_whoop_auth())
+    # Run authentication and the credential test on one event loop
+    success, test_success = asyncio.run(authenticate_and_test())
     
     if success:
-        # Test credentials
-        test_success = asyncio.run(test_credentials())
-        
         if test_success:
             print("\n🎉 Authentication complete!")
             print("💡 You can now run: python src/custom_sleep_fetcher.py")